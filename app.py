@@ -4,33 +4,126 @@ from flask import Flask, request, Response
 from flask_cors import CORS
 import redis
 from rq import Worker, Queue, Connection
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from decouple import config
 from geomet import wkb, wkt
 import pandas as pd
 
+import codecs
+import gzip
 import json
 import datetime
 import math
 import io
 import sys
+import threading
+import time
+import uuid
 
 from models import *
-from utils import get_data, get_download
+import utils
+from db import SESSION, DB_POOL_SIZE
+from utils import get_data, get_download, build_shapes, build_tile, build_predict, estimate_data_rows, normalizers_cached, PREDICT_FORMATS, MAP_FORMATS, JSON_ENCODERS
+from cache import CONN, SHAPES_TTL, PREDICT_TTL, get_or_set_body, result_key, data_key, get_result, set_result, claim_job, replace_job, release_job, publish_job, allow_job, watch_job, get_partial
+from results import BACKEND, gunzip, read_text
+from reference import reference
+from metrics import render_metrics
 
 
 # Create Flask app and allow for CORS
 app     = Flask(__name__)
 redis_url = config('REDIS_URL')
 q         = Queue('high', connection=redis.from_url(redis_url))
+export_q  = Queue('export', connection=q.connection)
 CORS(app)
 
-# Connect to DB and create session with DB
-DB_URI  = config('DB_URI')
-ENGINE  = create_engine(DB_URI)
-Session = sessionmaker(bind=ENGINE)
-SESSION = Session()
+# Seconds a data or export job may run, and keeps its status once finished
+DATA_TIMEOUT   = config('DATA_TIMEOUT', default=300, cast=int)
+EXPORT_TIMEOUT = config('EXPORT_TIMEOUT', default=1800, cast=int)
+JOB_RESULT_TTL = config('JOB_RESULT_TTL', default=3600, cast=int)
+
+# Exports waiting in queue before new ones are refused
+MAX_PENDING_EXPORTS = config('MAX_PENDING_EXPORTS', default=20, cast=int)
+
+# Data jobs estimated to read at most this many rows run within the request,
+# 0 queues every job
+SYNC_MAX_ROWS = config('SYNC_MAX_ROWS', default=20000, cast=int)
+# Jobs running within requests at once in each web process, each on the one DB
+# connection of its request: their chart queries run one after the other
+# rather than on CHART_WORKERS connections of their own
+INLINE_MAX_JOBS = config('INLINE_MAX_JOBS', default=DB_POOL_SIZE, cast=int)
+inline_jobs = threading.BoundedSemaphore(INLINE_MAX_JOBS)
+utils.CHART_WORKERS = 1
+
+# New jobs a client may start per window of RATE_WINDOW seconds
+RATE_LIMIT  = config('RATE_LIMIT', default=30, cast=int)
+RATE_WINDOW = config('RATE_WINDOW', default=60, cast=int)
+
+# Deepest map zoom level for shapes and tiles
+MAX_ZOOM = 20
+
+# Seconds between keepalives and before closing of job event streams
+SSE_HEARTBEAT = config('SSE_HEARTBEAT', default=15, cast=int)
+SSE_TIMEOUT   = config('SSE_TIMEOUT', default=600, cast=int)
+# Event streams open at once in each web process, leaving room for requests
+SSE_MAX_STREAMS = config('SSE_MAX_STREAMS', default=500, cast=int)
+streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+
+# Release the DB session of each request
+@app.teardown_appcontext
+def remove_session(exception=None):
+    SESSION.remove()
+
+
+# Respond with a cached body, honouring If-None-Match and Accept-Encoding
+def body_response(cached, mimetype):
+    etag, body = cached
+    headers = {"ETag": '"{}"'.format(etag), "Vary": "Accept-Encoding"}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body = gzip.decompress(body)
+    return Response(response=body, status=200, mimetype=mimetype, headers=headers)
+
+
+class TooManyJobs(Exception):
+    """Raised when a job is refused to keep the queues responsive."""
+
+    def __init__(self, message, retry_after):
+        super(TooManyJobs, self).__init__(message)
+        self.retry_after = retry_after
+
+
+# Refuse job with 429 Too Many Requests
+@app.errorhandler(TooManyJobs)
+def too_many_jobs(error):
+    return Response(
+        response=json.dumps({'id': None, 'error_message': str(error)}),
+        status=429,
+        mimetype='application/json',
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+
+# Identify client, from the address the router appends to X-Forwarded-For
+def client_id():
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded:
+        return forwarded.split(",")[-1].strip()
+    return request.remote_addr
+
+
+# Identify the browser session of a client from the X-Session-Id header or
+# the session argument, a random id the client keeps for the session
+def session_id():
+    session = request.headers.get("X-Session-Id") or request.args.get("session")
+    return session[:64] if session else None
 
 
 # Query for job
@@ -38,12 +131,248 @@ def get_status(job):
     status = {
         'id': job.id,
         'result': job.result,
-        'status': 'failed' if job.is_failed else 'pending' if job.result == None else 'completed'
+        'status': 'cancelled' if job.meta.get('cancelled') else 'failed' if job.is_failed else 'pending' if job.result == None else 'completed'
     }
     status.update(job.meta)
     return status
 
 
+# Keep result of completed job in the result cache for identical requests
+def register_result(job):
+    key = job.meta.get("cache_key")
+    if key:
+        for result_id in set_result(key, job.result, BACKEND.size(job.result)):
+            BACKEND.delete(result_id)
+        release_job(key)
+
+
+# Merge a part of a result filled in by a chart into target
+def merge_part(target, part):
+    for k, v in part.items():
+        if isinstance(v, dict) and isinstance(target.get(k), dict):
+            merge_part(target[k], v)
+        else:
+            target[k] = v
+    return target
+
+
+# Query for job, checking that the result of a completed job still exists. A
+# pending job reports the parts of its result its finished charts filled in
+# as partial, leaving out the charts in sent and adding the others to it.
+def job_output(job, sent=None):
+    output = get_status(job)
+    if output["status"] == "pending":
+        parts = get_partial(job.id, sent or ())
+        if sent is not None:
+            sent.update(parts)
+        if parts:
+            output["partial"] = {}
+            for part in parts.values():
+                merge_part(output["partial"], part)
+    if output["status"] == "completed":
+        if BACKEND.exists(job.result):
+            register_result(job)
+        else:
+            output["status"] = "failed"
+            output["error_message"] = "Result of job " + job.id + " has expired"
+    return output
+
+
+# Get the job with job_id from whichever queue it was put on, or None
+def fetch_job(job_id):
+    try:
+        return Job.fetch(job_id, connection=q.connection)
+    except NoSuchJobError:
+        return None
+
+
+# Cancel job if it is still waiting in queue
+def cancel_job(job_id):
+    found_job = fetch_job(job_id)
+    if found_job is None or not Queue(found_job.origin, connection=q.connection).remove(found_job):
+        return
+    key = found_job.meta.get("cache_key")
+    if key:
+        release_job(key)
+    found_job.meta["cancelled"] = True
+    found_job.save_meta()
+    found_job.cleanup(JOB_RESULT_TTL)
+    publish_job(job_id, "cancelled")
+
+
+# Record the job the session of the client now waits on for view, cancelling
+# the job it waited on before for view unless other sessions wait on it as
+# well. Requests without a session or a view never supersede a job.
+def supersede_job(view, output):
+    session = session_id()
+    if view is not None and session and output["status"] == "pending" and output["id"]:
+        stale_id = watch_job(session, view, output["id"], JOB_RESULT_TTL)
+        if stale_id is not None:
+            cancel_job(stale_id)
+    return output
+
+
+# Run a job within the request if cheap tells that it is cheap, caching its
+# result. Returns its output, or None if it is not cheap.
+def run_inline(key, func, args, cheap):
+    if not cheap():
+        return None
+    try:
+        result_id = func(*args)
+    except Exception as e:
+        app.logger.exception("Inline job failed")
+        return {"id": None, "result": None, "status": "failed", "error_message": "{}: {}".format(type(e).__name__, e)}
+    for evicted_id in set_result(key, result_id, BACKEND.size(result_id)):
+        BACKEND.delete(evicted_id)
+    return {"id": None, "result": result_id, "status": "completed"}
+
+
+# Answer request from the result cache or an identical job in progress, or
+# start a new job on queue, if the client is within its rate limit. If cheap
+# tells that the job is cheap, it runs within the request instead, unless
+# INLINE_MAX_JOBS already do; the rate limit is then checked before cheap,
+# which queries the DB.
+def start_job(key, view, queue, timeout, func, *args, cheap=None):
+    result_id = get_result(key)
+    if result_id is not None and BACKEND.exists(result_id):
+        BACKEND.touch(result_id)
+        return {"id": None, "result": result_id, "status": "completed"}
+    if cheap is not None and not allow_job(client_id(), RATE_LIMIT, RATE_WINDOW):
+        raise TooManyJobs("Too many requests, try again later", RATE_WINDOW)
+    if cheap is not None and inline_jobs.acquire(blocking=False):
+        try:
+            output = run_inline(key, func, args, cheap)
+        finally:
+            inline_jobs.release()
+        if output is not None:
+            return output
+    job_id = str(uuid.uuid4())
+    found_id = claim_job(key, job_id)
+    while found_id is not None:
+        # Join the job registered for key unless it is gone or ended without
+        # a result, in which case take its place
+        found_job = fetch_job(found_id)
+        if found_job is not None:
+            output = job_output(found_job)
+            if output["status"] not in ("failed", "cancelled"):
+                return supersede_job(view, output)
+        found_id = replace_job(key, found_id, job_id)
+    if queue is export_q and len(export_q) >= MAX_PENDING_EXPORTS:
+        release_job(key)
+        raise TooManyJobs("Too many exports are waiting, try again later", EXPORT_TIMEOUT // 10)
+    if cheap is None and not allow_job(client_id(), RATE_LIMIT, RATE_WINDOW):
+        release_job(key)
+        raise TooManyJobs("Too many requests, try again later", RATE_WINDOW)
+    new_job = queue.enqueue(
+        func, *args,
+        job_id=job_id,
+        job_timeout=timeout,
+        result_ttl=JOB_RESULT_TTL,
+        meta={"cache_key": key}
+    )
+    return supersede_job(view, get_status(new_job))
+
+
+# Respond with job output, reading the result of a completed job into it
+def output_response(output):
+    if output["status"] == "completed":
+        try:
+            output["result"] = read_text(output["result"])
+        except KeyError:
+            output["status"] = "failed"
+            output["error_message"] = "Result has expired"
+    return Response(
+        response=json.dumps(output),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+# Respond with job output, streaming the result of a completed job into it
+# without loading it in memory. With format=csv the result alone is streamed,
+# gzip encoded if the client accepts it.
+def stream_response(output):
+    if output["status"] != "completed":
+        return output_response(output)
+    try:
+        chunks = BACKEND.read_compressed(output["result"])
+    except KeyError:
+        return output_response(output)
+    if request.args.get("format") == "csv":
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            return Response(chunks, status=200, mimetype='text/csv', headers={"Content-Encoding": "gzip"})
+        return Response(gunzip(chunks), status=200, mimetype='text/csv')
+    def generate():
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        yield json.dumps({k: output[k] for k in output if k != "result"})[:-1] + ', "result": "'
+        for chunk in gunzip(chunks):
+            yield json.dumps(decoder.decode(chunk))[1:-1]
+        yield json.dumps(decoder.decode(b"", final=True))[1:-1] + '"}'
+    return Response(generate(), status=200, mimetype='application/json')
+
+
+# Format server-sent event
+def sse(event, data):
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
+# Stream status events of job until it completes or fails, woken up by the
+# notifications the worker publishes on the channel of the job. Each status
+# event carries only the charts finished since the previous one. The final
+# result event includes the result if with_result is set.
+def job_events(job_id, with_result):
+    pubsub = CONN.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("job:" + job_id)
+    try:
+        last = None
+        sent = set()
+        deadline = time.time() + SSE_TIMEOUT
+        while time.time() < deadline:
+            found_job = fetch_job(job_id)
+            if found_job is None:
+                yield sse("error", {'id': None, 'error_message': 'No job exists with the id number ' + job_id})
+                return
+            output = job_output(found_job, sent)
+            output["id"] = job_id
+            if output["status"] != "pending":
+                if with_result and output["status"] == "completed":
+                    try:
+                        output["result"] = read_text(output["result"])
+                    except KeyError:
+                        output["status"] = "failed"
+                        output["error_message"] = "Result has expired"
+                yield sse("result", output)
+                return
+            if output != last:
+                yield sse("status", output)
+                last = output
+            else:
+                yield ": keepalive\n\n"
+            pubsub.get_message(timeout=SSE_HEARTBEAT)
+    finally:
+        pubsub.close()
+
+
+# Respond with the event stream of job, or 503 when the process already
+# holds SSE_MAX_STREAMS streams and the client should poll instead
+def events_response(job_id, with_result):
+    if not streams.acquire(blocking=False):
+        return Response(
+            response=json.dumps({'id': None, 'error_message': 'Too many event streams, poll with job instead'}),
+            status=503,
+            mimetype='application/json',
+            headers={"Retry-After": str(SSE_HEARTBEAT)}
+        )
+    response = Response(
+        job_events(job_id, with_result),
+        status=200,
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    response.call_on_close(streams.release)
+    return response
+
+
 # Endpoints for backend
 @app.route("/", methods=["GET"])
 def health_check():
@@ -54,64 +383,40 @@ def health_check():
     )
 
 
+# Get job metrics in Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Get the histograms of job, stage and query durations, the depth of the
+        queues and the utilization of the workers."""
+    return Response(
+        response=render_metrics(Queue.all(connection=q.connection)),
+        status=200,
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
 # Get list of cities in json format
 @app.route("/cities", methods=["GET"])
 def get_cities():
     """Get all cities in DB with respective id and user friendly name."""
-    cities = []
-    for instance in SESSION.query(City).all():
-        if instance.state:
-            cities.append({
-                "id": instance.id,
-                "string": "{}, {}, {}".format(
-                    instance.city,
-                    instance.state,
-                    instance.country
-                ).title()
-            })
-        else:
-            cities.append({
-                "id": instance.id,
-                "string": "{}, {}".format(
-                    instance.city,
-                    instance.country
-                ).title()
-            })
-    return Response(
-        response=json.dumps({"cities": cities, "error": "none"}),
-        status=200,
-        mimetype='application/json'
-    )
+    return body_response(reference()["cities"], 'application/json')
 
 
 # Get zipcode and census tract geometries
 @app.route("/city/<int:cityid>/shapes", methods=["GET"])
 def get_city_shapes(cityid):
     """Get all blocks for a specific City id with their respective id, shape
-        and the city center coordinates."""
-    if SESSION.query(City).filter(City.id == cityid).count() > 0:
-        citycoords_req = SESSION.query(City.location).filter(City.id == cityid)
-        citycoords_bytes = citycoords_req.one()[0].data.tobytes()
-        citycoords = wkb.loads(citycoords_bytes)["coordinates"]
-        blocks = [{
-            "id": block.id,
-            "shape": wkb.loads(block.shape.data.tobytes())["coordinates"]
-        } for block in
-            SESSION.query(Blocks).filter(Blocks.cityid == cityid).all()]
-        zipcodes = [{
-            "zipcode": zipcode.zipcode,
-            "shape": wkb.loads(zipcode.shape.data.tobytes())["coordinates"]
-        } for zipcode in
-            SESSION.query(ZipcodeGeom).filter(ZipcodeGeom.cityid == cityid).all()]
-        return Response(
-            response=json.dumps({
-                "error": "none",
-                "blocks": blocks,
-                "zipcodes": zipcodes,
-                "citylocation": citycoords}),
-            status=200,
-            mimetype='application/json'
-        )
+        and the city center coordinates. With zoom, shapes are simplified for
+        that map zoom level."""
+    zoom = request.args.get("zoom")
+    zoom = min(max(int(zoom), 0), MAX_ZOOM) if zoom else None
+    cached = get_or_set_body(
+        "shapes:{}:{}".format(cityid, zoom),
+        lambda: build_shapes(cityid, zoom),
+        SHAPES_TTL
+    )
+    if cached:
+        return body_response(cached, 'application/json')
     return Response(
         response=json.dumps({"error": "Incorrect city id value."}),
         status=404,
@@ -119,18 +424,44 @@ def get_city_shapes(cityid):
     )
 
 
+# Get vector tile of zipcode and census tract geometries
+@app.route("/city/<int:cityid>/tiles/<int:z>/<int:x>/<int:y>", methods=["GET"])
+def get_city_tile(cityid, z, x, y):
+    """Get the Mapbox vector tile z/x/y of the blocks and zipcodes of a
+        specific City id."""
+    if z < 0 or z > MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        return Response(
+            response=json.dumps({"error": "Incorrect tile value."}),
+            status=404,
+            mimetype='application/json'
+        )
+    cached = get_or_set_body(
+        "tile:{}:{}:{}:{}".format(cityid, z, x, y),
+        lambda: build_tile(cityid, z, x, y),
+        SHAPES_TTL
+    )
+    return body_response(cached, 'application/vnd.mapbox-vector-tile')
+
+
 # Get prediction values for city
 @app.route("/city/<int:cityid>/predict", methods=["GET"])
 def get_predict_data(cityid):
-    query = """SELECT blockid, prediction FROM block WHERE cityid = :cityid AND prediction ID NOT NULL;"""
-    prediction = {}
-    for row in SESSION.execute(text(query), {"cityid": cityid}).fetchall():
-        prediction[r[0]] = np.frombuffer(row[1], dtype=np.float64).reshape((12,168)).tolist()
-    return Response(
-        response=json.dumps({"error": "none", "prediction": json.dumps(prediction)}),
-        status=200,
-        mimetype='application/json'
+    """Get the predictions of all blocks of a specific City id, as JSON or
+        with format set to float32, float16 or uint8 as a packed binary
+        array (see utils.build_predict)."""
+    fmt = request.args.get("format", "json")
+    if fmt not in PREDICT_FORMATS:
+        return Response(
+            response=json.dumps({"error": "Incorrect format value."}),
+            status=400,
+            mimetype='application/json'
+        )
+    cached = get_or_set_body(
+        "predict:{}:{}".format(cityid, fmt),
+        lambda: build_predict(cityid, fmt),
+        PREDICT_TTL
     )
+    return body_response(cached, 'application/json' if fmt == "json" else 'application/octet-stream')
 
 
 # Start job in queue or download incident data for city
@@ -138,29 +469,14 @@ def get_predict_data(cityid):
 def download_data(cityid):
     query_id = request.args.get('job')
     if query_id:
-        found_job = q.fetch_job(query_id)
+        found_job = fetch_job(query_id)
         if found_job:
-            output = get_status(found_job)
+            output = job_output(found_job)
+            output["id"] = query_id
             if output["status"] == "completed":
-                job = SESSION.query(Job).filter(Job.id == output["result"]).one()
-                output["id"] = query_id
-                output["result"] = job.result
                 print(output)
                 sys.stdout.flush()
-                SESSION.delete(job)
-                SESSION.commit()
-                return Response(
-                    response=json.dumps(output),
-                    status=200,
-                    mimetype='application/json'
-                )
-            else:
-                output["id"] = query_id
-                return Response(
-                    response=json.dumps(output),
-                    status=200,
-                    mimetype='application/json'
-                )
+            return stream_response(output)
         else:
             output = { 'id': None, 'error_message': 'No job exists with the id number ' + query_id }
             return Response(
@@ -181,41 +497,33 @@ def download_data(cityid):
         locdesc1 = request.args.get("locdesc1","").split(",")
         locdesc2 = request.args.get("locdesc2","").split(",")
         locdesc3 = request.args.get("locdesc3","").split(",")    
-        new_job = q.enqueue(get_download, config_dict, dotw, crimetypes, locdesc1, locdesc2, locdesc3)
-        output = get_status(new_job)
-        return Response(
-            response=json.dumps(output),
-            status=200,
-            mimetype='application/json'
-        )
+        key = result_key("download", config_dict, sorted(dotw.split(",")), sorted(crimetypes.split(",")), locdesc1, locdesc2, locdesc3)
+        output = start_job(key, None, export_q, EXPORT_TIMEOUT, get_download, config_dict, dotw, crimetypes, locdesc1, locdesc2, locdesc3)
+        return stream_response(output)
+
+
+# Stream status of export job
+@app.route("/city/<int:cityid>/download/events", methods=["GET"])
+def download_events(cityid):
+    """Stream the status of an export job as server-sent events until it
+        completes. The result is fetched from /download with the job id."""
+    return events_response(request.args.get('job', ''), False)
 
 
 # Get aggregate data for city
 @app.route("/city/<int:cityid>/data", methods=["GET"])
 def get_city_data(cityid):
-    """Get values for specified parameters and city."""
+    """Get values for specified parameters and city. With map set to
+        float32, uint16 or uint8 the block x month map is encoded compactly
+        (see utils.format_chart), and encoder=fast serializes the result with
+        a faster JSON encoder."""
     query_id = request.args.get('job')
     if query_id:
-        found_job = q.fetch_job(query_id)
+        found_job = fetch_job(query_id)
         if found_job:
-            output = get_status(found_job)
-            if output["status"] == "completed":
-                job = SESSION.query(Job).filter(Job.id == output["result"]).one()
-                output["result"] = job.result
-                SESSION.delete(job)
-                SESSION.commit()
-                return Response(
-                    response=json.dumps(output),
-                    status=200,
-                    mimetype='application/json'
-                )
-            else:
-                output["id"] = query_id
-                return Response(
-                    response=json.dumps(output),
-                    status=200,
-                    mimetype='application/json'
-                )
+            output = job_output(found_job)
+            output["id"] = query_id
+            return output_response(output)
         else:
             output = { 'id': None, 'error_message': 'No job exists with the id number ' + query_id }
             return Response(
@@ -246,13 +554,29 @@ def get_city_data(cityid):
         locdesc1 = request.args.get("locdesc1","").split(",")
         locdesc2 = request.args.get("locdesc2","").split(",")
         locdesc3 = request.args.get("locdesc3","").split(",")
-        new_job = q.enqueue(get_data, config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3)
-        output = get_status(new_job)
-        return Response(
-            response=json.dumps(output),
-            status=200,
-            mimetype='application/json'
+        map_format = request.args.get("map", "full")
+        encoder = request.args.get("encoder", "json")
+        if map_format not in MAP_FORMATS or encoder not in JSON_ENCODERS:
+            return Response(
+                response=json.dumps({"error": "Incorrect map or encoder value."}),
+                status=400,
+                mimetype='application/json'
+            )
+        key = data_key(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3, map_format, encoder)
+        output = start_job(
+            key, "data:{}".format(cityid), q, DATA_TIMEOUT,
+            get_data, config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3, map_format, encoder,
+            cheap=lambda: SYNC_MAX_ROWS > 0 and normalizers_cached(config_dict) and estimate_data_rows(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3) <= SYNC_MAX_ROWS
         )
+        return output_response(output)
+
+
+# Stream status and result of data job
+@app.route("/city/<int:cityid>/data/events", methods=["GET"])
+def get_city_data_events(cityid):
+    """Stream the status of a data job as server-sent events, ending with its
+        result."""
+    return events_response(request.args.get('job', ''), True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+"""Contains Redis caches shared by the web and worker processes."""
+
+from decouple import config
+import redis
+from redis.exceptions import WatchError
+
+import gzip
+import hashlib
+import json
+import time
+
+
+redis_url = config('REDIS_URL')
+CONN      = redis.from_url(redis_url)
+
+NORMALIZER_TTL = config('NORMALIZER_TTL', default=7 * 24 * 3600, cast=int)
+SHAPES_TTL     = config('SHAPES_TTL', default=24 * 3600, cast=int)
+PREDICT_TTL    = config('PREDICT_TTL', default=24 * 3600, cast=int)
+
+
+def get_or_set(key, compute, ttl):
+    """Get the JSON value cached under key, computing and caching it with the
+        given time to live on a miss."""
+    value = CONN.get(key)
+    if value is not None:
+        return json.loads(value)
+    value = compute()
+    CONN.set(key, json.dumps(value), ex=ttl)
+    return value
+
+
+def encode_body(body):
+    """Get the ETag and gzip compressed form of a response body."""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return hashlib.sha1(body).hexdigest(), gzip.compress(body)
+
+
+def get_or_set_body(key, compute, ttl):
+    """Get the ETag and gzip compressed response body cached under key,
+        computing the body with compute and caching it with the given time to
+        live on a miss. Returns None if compute does."""
+    etag, body = CONN.hmget(key, "etag", "body")
+    if etag is not None:
+        return etag.decode("utf-8"), body
+    body = compute()
+    if body is None:
+        return None
+    etag, body = encode_body(body)
+    pipe = CONN.pipeline()
+    pipe.hmset(key, {"etag": etag, "body": body})
+    pipe.expire(key, ttl)
+    pipe.execute()
+    return etag, body
+
+
+RESULT_TTL         = config('RESULT_CACHE_TTL', default=3600, cast=int)
+RESULT_MAX_ENTRIES = config('RESULT_CACHE_MAX_ENTRIES', default=1000, cast=int)
+RESULT_MAX_BYTES   = config('RESULT_CACHE_MAX_BYTES', default=256 * 1024 * 1024, cast=int)
+
+# Generation of the incident data and block populations, part of every result
+# and normalizer cache key
+GENERATION_KEY = "result:generation"
+
+
+def data_generation():
+    """Get the current generation of the incident data and block
+        populations."""
+    return int(CONN.get(GENERATION_KEY) or 0)
+
+
+def result_key(kind, *args):
+    """Get the result cache key of a job from its kind and arguments. The
+        arguments are hashed in canonical JSON form along with the current
+        generation of the data, so results computed before a data change are
+        never served after it."""
+    args = json.dumps([kind, data_generation()] + list(args), sort_keys=True, separators=(",", ":"))
+    return "result:" + hashlib.sha256(args.encode("utf-8")).hexdigest()
+
+
+def invalidate_results():
+    """Start a new generation of the incident data, after incidents were added
+        or changed or block populations changed. Cached results and
+        normalizers of older generations are no longer looked up and age out
+        of the cache."""
+    CONN.incr(GENERATION_KEY)
+
+
+def data_key(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3, map_format, encoder):
+    """Get the result cache key of a data job from its arguments. Requests
+        differing only in the order of their days of the week or crime types
+        share a key."""
+    return result_key("data", config_dict, blockid, sorted(dotw.split(",")), sorted(crimetypes.split(",")), locdesc1, locdesc2, locdesc3, map_format, encoder)
+
+
+def get_result(key):
+    """Get the id of the cached result under key, or None. A hit refreshes the
+        time to live and the recency of the entry."""
+    value = CONN.get(key)
+    if value is None:
+        return None
+    pipe = CONN.pipeline()
+    pipe.expire(key, RESULT_TTL)
+    pipe.zadd("result:lru", {key: time.time()})
+    pipe.execute()
+    return value.decode("utf-8")
+
+
+def set_result(key, result_id, size):
+    """Cache the id of a result of size bytes under key, evicting the least
+        recently used entries above RESULT_MAX_ENTRIES or RESULT_MAX_BYTES in
+        total. Results larger than RESULT_MAX_BYTES are not cached. Returns
+        the ids of the evicted results."""
+    if size > RESULT_MAX_BYTES:
+        return []
+    now = time.time()
+    pipe = CONN.pipeline()
+    pipe.set(key, result_id, ex=RESULT_TTL)
+    pipe.zadd("result:lru", {key: now})
+    pipe.hset("result:sizes", key, size)
+    pipe.zrangebyscore("result:lru", 0, now - RESULT_TTL)
+    pipe.zremrangebyscore("result:lru", 0, now - RESULT_TTL)
+    expired = pipe.execute()[3]
+    if expired:
+        CONN.hdel("result:sizes", *expired)
+    pipe = CONN.pipeline()
+    pipe.zrange("result:lru", 0, -1)
+    pipe.hgetall("result:sizes")
+    keys, sizes = pipe.execute()
+    total = sum(int(sizes.get(k, 0)) for k in keys)
+    evicted = []
+    for k in keys:
+        if len(keys) - len(evicted) <= RESULT_MAX_ENTRIES and total <= RESULT_MAX_BYTES:
+            break
+        evicted.append(k)
+        total -= int(sizes.get(k, 0))
+    if not evicted:
+        return []
+    pipe = CONN.pipeline()
+    pipe.mget(evicted)
+    pipe.zrem("result:lru", *evicted)
+    pipe.hdel("result:sizes", *evicted)
+    pipe.delete(*evicted)
+    return [v.decode("utf-8") for v in pipe.execute()[0] if v is not None]
+
+
+def claim_job(key, job_id):
+    """Register job_id as the job computing the result under key. Returns the
+        id of the job already registered for key, or None if job_id was
+        registered."""
+    while not CONN.set("inflight:" + key, job_id, nx=True, ex=RESULT_TTL):
+        found = CONN.get("inflight:" + key)
+        if found is not None:
+            return found.decode("utf-8")
+    return None
+
+
+def replace_job(key, old_id, job_id):
+    """Register job_id as the job computing the result under key in place of
+        old_id, a job that no longer runs. Returns the id of a job another
+        request registered for key meanwhile, or None if job_id was
+        registered."""
+    with CONN.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch("inflight:" + key)
+                found = pipe.get("inflight:" + key)
+                if found is not None and found.decode("utf-8") != old_id:
+                    return found.decode("utf-8")
+                pipe.multi()
+                pipe.set("inflight:" + key, job_id, ex=RESULT_TTL)
+                pipe.execute()
+                return None
+            except WatchError:
+                continue
+
+
+def release_job(key):
+    """Unregister the job computing the result under key."""
+    CONN.delete("inflight:" + key)
+
+
+def publish_job(job_id, status):
+    """Notify the subscribers of the channel of a job that its status
+        changed."""
+    CONN.publish("job:" + job_id, status)
+
+
+def add_partial(job_id, chart, value):
+    """Record the part of the result of a job that a finished chart filled
+        in."""
+    pipe = CONN.pipeline()
+    pipe.hset("partial:" + job_id, chart, json.dumps(value))
+    pipe.expire("partial:" + job_id, RESULT_TTL)
+    pipe.execute()
+
+
+def get_partial(job_id, skip=()):
+    """Get the parts of the result of a job filled in by its finished charts
+        other than those in skip, by chart name."""
+    charts = [k.decode("utf-8") for k in CONN.hkeys("partial:" + job_id)]
+    charts = [k for k in charts if k not in skip]
+    if not charts:
+        return {}
+    values = CONN.hmget("partial:" + job_id, charts)
+    return {k: json.loads(v) for k, v in zip(charts, values) if v is not None}
+
+
+def allow_job(client, limit, window):
+    """Count a new job of client in the current fixed window of window
+        seconds. Returns False once client started more than limit jobs in
+        the window."""
+    key = "rate:{}:{}".format(client, int(time.time() // window))
+    pipe = CONN.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, window)
+    return pipe.execute()[0] <= limit
+
+
+def watch_job(client, view, job_id, ttl):
+    """Record job_id as the latest job client waits on for view. Returns the
+        id of the job client waited on for view before, if client was its last
+        waiter, or None."""
+    pipe = CONN.pipeline()
+    pipe.sadd("waiters:" + job_id, client)
+    pipe.expire("waiters:" + job_id, ttl)
+    pipe.getset("latest:{}:{}".format(client, view), job_id)
+    pipe.expire("latest:{}:{}".format(client, view), ttl)
+    found = pipe.execute()[2]
+    if found is None or found.decode("utf-8") == job_id:
+        return None
+    found = found.decode("utf-8")
+    pipe = CONN.pipeline()
+    pipe.srem("waiters:" + found, client)
+    pipe.scard("waiters:" + found)
+    return found if pipe.execute()[1] == 0 else None
@@ -0,0 +1,89 @@
+"""Contains the DB engine and sessions shared by the web and worker
+    processes."""
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import scoped_session, sessionmaker
+from decouple import config
+
+import functools
+import os
+
+# Under the gevent workers of the web process, make psycopg2 wait for the DB
+# cooperatively so that a query only blocks its own greenlet
+try:
+    from gevent import monkey
+    from psycogreen.gevent import patch_psycopg
+    if monkey.is_module_patched("socket"):
+        patch_psycopg()
+except ImportError:
+    pass
+
+
+DB_URI          = config('DB_URI')
+DB_POOL_SIZE    = config('DB_POOL_SIZE', default=5, cast=int)
+DB_MAX_OVERFLOW = config('DB_MAX_OVERFLOW', default=10, cast=int)
+DB_POOL_RECYCLE = config('DB_POOL_RECYCLE', default=1800, cast=int)
+DB_POOL_TIMEOUT = config('DB_POOL_TIMEOUT', default=30, cast=int)
+
+# Connect to DB with a connection pool shared by all threads of a process
+ENGINE  = create_engine(
+    DB_URI,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_pre_ping=True
+)
+
+
+# Connections are owned by the process that opened them. A process forked off
+# one holding pooled connections, such as an RQ work horse, starts with an
+# empty pool of its own, since pool_pre_ping would otherwise ping over the
+# sockets of its parent before any checkout listener runs. The inherited
+# connections are kept rather than closed, which would end them for the parent
+# too.
+INHERITED_POOLS = []
+
+
+def detach_pool():
+    INHERITED_POOLS.append(ENGINE.pool)
+    ENGINE.pool = ENGINE.pool.recreate()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=detach_pool)
+
+
+# Without fork hooks (before Python 3.7), the pid a connection was opened in
+# is checked on checkout instead
+@event.listens_for(ENGINE, "connect")
+def record_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+@event.listens_for(ENGINE, "checkout")
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info["pid"] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid {}, attempting to check out in pid {}".format(
+                connection_record.info["pid"], os.getpid()
+            )
+        )
+
+
+Session = sessionmaker(bind=ENGINE)
+# Session of the current thread, removed at the end of each request and job
+SESSION = scoped_session(Session)
+
+
+def job_session(func):
+    """Decorate a queue job to remove its session when it finishes, so that
+        a failed transaction does not leak into the next job."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            SESSION.remove()
+    return wrapper
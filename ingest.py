@@ -0,0 +1,164 @@
+"""Loads raw incident CSVs of a city into DB."""
+
+from sqlalchemy import text
+from psycopg2.extras import execute_values
+from decouple import config
+from rq import Queue, get_current_job
+import pandas as pd
+
+import io
+import sys
+import time
+
+from models import *
+from db import ENGINE, SESSION, job_session
+from cache import CONN, invalidate_results
+from utils import COORDS_ORDER, GEOM_SRID, ensure_partitions, refresh_rollup
+from predictions import compute_predictions
+from reference import invalidate_reference
+from warm import warm_caches
+
+
+INGEST_CHUNK_SIZE = config('INGEST_CHUNK_SIZE', default=100000, cast=int)
+
+# Columns of the raw CSVs, the same as in get_download's export
+INGEST_COLUMNS = ["datetime", "latitude", "longitude", "category", "location_key1", "location_key2", "location_key3"]
+STAGING_COLUMNS = ["row", "crimetypeid", "locdescid", "datetime", "hour", "dow", "month", "year", "x", "y"]
+
+query_locdescs = """SELECT locdesctype.id, locdesctype.key1, locdesctype.key2, locdesctype.key3
+    FROM locdesctype
+    INNER JOIN (VALUES %s) AS keys (key1, key2, key3)
+        ON locdesctype.key1 = keys.key1 AND locdesctype.key2 = keys.key2 AND locdesctype.key3 = keys.key3;"""
+
+query_staging = """CREATE TEMP TABLE IF NOT EXISTS incident_staging (
+    row         BIGINT,
+    crimetypeid BIGINT,
+    locdescid   BIGINT,
+    datetime    TIMESTAMP,
+    hour        INTEGER,
+    dow         INTEGER,
+    month       INTEGER,
+    year        INTEGER,
+    x           DOUBLE PRECISION,
+    y           DOUBLE PRECISION
+);"""
+
+# Assign each staged incident to the block containing it, in one join
+query_merge = """INSERT INTO incident (crimetypeid, locdescid, cityid, blockid, location, datetime, hour, dow, month, year)
+    SELECT DISTINCT ON (staging.row)
+        staging.crimetypeid,
+        staging.locdescid,
+        %(cityid)s,
+        block.id,
+        staging.location,
+        staging.datetime,
+        staging.hour,
+        staging.dow,
+        staging.month,
+        staging.year
+    FROM (
+        SELECT *, ST_SetSRID(ST_MakePoint(x, y), %(srid)s) AS location FROM incident_staging
+    ) AS staging
+    INNER JOIN block ON block.cityid = %(cityid)s AND ST_Contains(block.shape, staging.location)
+    ORDER BY staging.row, block.id;"""
+
+
+def location_key(key1, key2, key3):
+    """Get the lookup key of a location description."""
+    return key1 + "\x1f" + key2 + "\x1f" + key3
+
+
+def derive_columns(chunk, crimetypes, locdescs):
+    """Derive the staging columns of a chunk of raw incidents. Rows with an
+        invalid datetime or location, or an unknown crime type, are dropped."""
+    dt = pd.to_datetime(chunk["datetime"], errors="coerce")
+    latitude = pd.to_numeric(chunk["latitude"], errors="coerce")
+    longitude = pd.to_numeric(chunk["longitude"], errors="coerce")
+    keys = chunk["location_key1"].fillna("") + "\x1f" + chunk["location_key2"].fillna("") + "\x1f" + chunk["location_key3"].fillna("")
+    staged = pd.DataFrame({
+        "row": chunk.index,
+        "crimetypeid": chunk["category"].map(crimetypes),
+        "locdescid": keys.map(locdescs),
+        "datetime": dt,
+        "hour": dt.dt.hour,
+        # Sunday is 0, as with EXTRACT(DOW ...)
+        "dow": (dt.dt.dayofweek + 1) % 7,
+        "month": dt.dt.month,
+        "year": dt.dt.year,
+        "x": latitude if COORDS_ORDER == "latlon" else longitude,
+        "y": longitude if COORDS_ORDER == "latlon" else latitude
+    }, columns=STAGING_COLUMNS)
+    staged = staged.dropna()
+    for c in ["row", "crimetypeid", "locdescid", "hour", "dow", "month", "year"]:
+        staged[c] = staged[c].astype("int64")
+    return staged
+
+
+@job_session
+def ingest_csv(cityid, path, chunksize=INGEST_CHUNK_SIZE):
+    """Load the raw incident CSV at path into a city, chunksize rows at a time.
+        The CSV needs a header with the INGEST_COLUMNS. Crime types are
+        resolved in memory and must already exist, unknown location
+        descriptions are created. Each chunk is copied into a staging table
+        and merged into incident with its blocks assigned by a point in
+        polygon join; incidents outside every block are dropped. The rollup
+        refresh, the prediction update and the warming of the caches of the
+        city are queued afterwards."""
+    crimetypes = {r.category: r.id for r in SESSION.query(CrimeType.category, CrimeType.id).all()}
+    locdescs = {location_key(r.key1, r.key2, r.key3): r.id for r in SESSION.query(LocationDescriptionType).all()}
+    SESSION.remove()
+    stats = {"cityid": cityid, "read": 0, "loaded": 0, "seconds": 0.0, "rows_per_sec": 0.0}
+    job = get_current_job()
+    start = time.time()
+    RAW_CONN = ENGINE.raw_connection()
+    try:
+        cursor = RAW_CONN.cursor()
+        cursor.execute(query_staging)
+        reader = pd.read_csv(path, usecols=INGEST_COLUMNS, dtype=str, chunksize=chunksize)
+        for chunk in reader:
+            stats["read"] += len(chunk)
+            for c in ["location_key1", "location_key2", "location_key3"]:
+                chunk[c] = chunk[c].fillna("")
+            keys = set(zip(chunk["location_key1"], chunk["location_key2"], chunk["location_key3"]))
+            new_keys = [k for k in keys if location_key(*k) not in locdescs]
+            if new_keys:
+                # Another ingest may have added some of the keys since they
+                # were loaded; look them up again once no other can add any
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext('locdesctype'));")
+                rows = execute_values(cursor, query_locdescs, new_keys, fetch=True)
+                locdescs.update({location_key(r[1], r[2], r[3]): r[0] for r in rows})
+                new_keys = [k for k in new_keys if location_key(*k) not in locdescs]
+            if new_keys:
+                rows = execute_values(cursor, "INSERT INTO locdesctype (key1, key2, key3) VALUES %s RETURNING id, key1, key2, key3;", new_keys, fetch=True)
+                locdescs.update({location_key(r[1], r[2], r[3]): r[0] for r in rows})
+            # Commit the new location descriptions, so the partitions of the
+            # chunk can be created in transactions of their own
+            RAW_CONN.commit()
+            if new_keys:
+                invalidate_reference()
+            staged = derive_columns(chunk, crimetypes, locdescs)
+            ensure_partitions(RAW_CONN, zip(staged["year"].tolist(), staged["month"].tolist()))
+            with io.StringIO() as f:
+                staged.to_csv(f, index=False, header=False, date_format="%Y-%m-%d %H:%M:%S")
+                f.seek(0)
+                cursor.execute("TRUNCATE incident_staging;")
+                cursor.copy_expert("COPY incident_staging (" + ", ".join(STAGING_COLUMNS) + ") FROM STDIN WITH CSV;", f)
+            cursor.execute(query_merge, {"cityid": cityid, "srid": GEOM_SRID})
+            stats["loaded"] += cursor.rowcount
+            RAW_CONN.commit()
+            invalidate_results()
+            stats["seconds"] = time.time() - start
+            stats["rows_per_sec"] = stats["read"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+            print("Ingested {read} rows into city {cityid}, loaded {loaded}, {rows_per_sec:.0f} rows/sec".format(**stats))
+            sys.stdout.flush()
+            if job:
+                job.meta["ingest"] = stats
+                job.save_meta()
+        cursor.close()
+    finally:
+        RAW_CONN.close()
+    q = Queue('low', connection=CONN)
+    refresh = q.enqueue(refresh_rollup)
+    predict = q.enqueue(compute_predictions, cityid, depends_on=refresh)
+    q.enqueue(warm_caches, [cityid], depends_on=predict)
+    return stats
@@ -0,0 +1,223 @@
+"""Contains the instrumentation of queue jobs: timings of the SQL statements
+    and stages of each job, attached to its meta, and histograms aggregated in
+    Redis for the /metrics endpoint."""
+
+from sqlalchemy import event
+from rq import Worker, get_current_job
+
+import contextlib
+import functools
+import threading
+import time
+
+from db import ENGINE
+from cache import CONN
+
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+HISTOGRAMS = {
+    "crime_job_seconds": "Duration of queue jobs.",
+    "crime_job_stage_seconds": "Duration of stages of queue jobs.",
+    "crime_job_query_seconds": "Duration of SQL statements of queue jobs."
+}
+COUNTERS = {
+    "crime_job_query_rows_total": "Rows returned by SQL statements of queue jobs.",
+    "crime_job_result_bytes_total": "Bytes of results serialized by queue jobs."
+}
+
+_local = threading.local()
+
+
+class Timings(object):
+    """Timing breakdown of one job. Statements and stages of the same name are
+        summed. Shared by the threads working for the job."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.stages = {}
+
+    def add_query(self, name, seconds, rows):
+        with self.lock:
+            entry = self.queries.setdefault(name, {"seconds": 0.0, "rows": 0, "count": 0})
+            entry["seconds"] += seconds
+            entry["rows"] += max(rows, 0)
+            entry["count"] += 1
+
+    def add_stage(self, name, seconds, size=None):
+        with self.lock:
+            entry = self.stages.setdefault(name, {"seconds": 0.0})
+            entry["seconds"] += seconds
+            if size is not None:
+                entry["bytes"] = entry.get("bytes", 0) + size
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "queries": {k: dict(v, seconds=round(v["seconds"], 4)) for k, v in self.queries.items()},
+                "stages": {k: dict(v, seconds=round(v["seconds"], 4)) for k, v in self.stages.items()}
+            }
+
+
+def current():
+    """Get the timings collected on this thread, or None."""
+    return getattr(_local, "timings", None)
+
+
+@contextlib.contextmanager
+def collect(timings):
+    """Collect the statements and stages run on this thread into timings."""
+    previous = current()
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+@contextlib.contextmanager
+def query(name):
+    """Name the SQL statements executed on this thread."""
+    previous = getattr(_local, "query", None)
+    _local.query = name
+    try:
+        yield
+    finally:
+        _local.query = previous
+
+
+class Stage(object):
+    """Context timing a stage of the current job. Set size to the bytes the
+        stage produced."""
+
+    def __init__(self, name):
+        self.name = name
+        self.size = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timings = current()
+        if timings is not None:
+            timings.add_stage(self.name, time.perf_counter() - self.start, self.size)
+
+
+def stage(name):
+    """Time a stage of the current job."""
+    return Stage(name)
+
+
+def record_query(name, seconds, rows):
+    """Record a statement of the current job run outside the engine, such as a
+        COPY on a raw connection."""
+    timings = current()
+    if timings is not None:
+        timings.add_query(name, seconds, rows)
+
+
+@event.listens_for(ENGINE, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if current() is not None:
+        conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+
+@event.listens_for(ENGINE, "after_cursor_execute")
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    timings = current()
+    if timings is not None and conn.info.get("statement_start"):
+        seconds = time.perf_counter() - conn.info["statement_start"].pop()
+        record_query(getattr(_local, "query", None) or "other", seconds, cursor.rowcount)
+
+
+def observe(kind, seconds, timings):
+    """Add the timings of a finished job of a kind to the histograms in
+        Redis."""
+    pipe = CONN.pipeline()
+
+    def histogram(name, labels, value):
+        key = "metrics:" + name
+        for le in BUCKETS + ["+Inf"]:
+            if le == "+Inf" or value <= le:
+                pipe.hincrby(key, "{}|{}".format(labels, le), 1)
+        pipe.hincrbyfloat(key, labels + "|sum", value)
+        pipe.hincrby(key, labels + "|count", 1)
+
+    histogram("crime_job_seconds", 'job="{}"'.format(kind), seconds)
+    for name, entry in timings["stages"].items():
+        histogram("crime_job_stage_seconds", 'job="{}",stage="{}"'.format(kind, name), entry["seconds"])
+        if "bytes" in entry:
+            pipe.hincrby("metrics:crime_job_result_bytes_total", 'job="{}"'.format(kind), entry["bytes"])
+    for name, entry in timings["queries"].items():
+        histogram("crime_job_query_seconds", 'job="{}",query="{}"'.format(kind, name), entry["seconds"])
+        pipe.hincrby("metrics:crime_job_query_rows_total", 'job="{}",query="{}"'.format(kind, name), entry["rows"])
+    pipe.execute()
+
+
+def timed_job(kind):
+    """Decorate a queue job to collect its timings, attach them to its meta
+        under "timings" and add them to the histograms."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = Timings()
+            start = time.perf_counter()
+            with collect(timings):
+                value = func(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            breakdown = timings.as_dict()
+            breakdown["seconds"] = round(seconds, 4)
+            job = get_current_job()
+            if job is not None:
+                job.meta["timings"] = breakdown
+                job.save_meta()
+            observe(kind, seconds, breakdown)
+            return value
+        return wrapper
+    return decorator
+
+
+def bucket_order(field):
+    """Sort key of a histogram field: by labels, then buckets by bound, then
+        sum and count."""
+    labels, le = field.rsplit("|", 1)
+    if le == "sum" or le == "count":
+        return labels, float("inf"), le
+    return labels, float(le), ""
+
+
+def render_metrics(queues):
+    """Render the histograms and counters, the depth of queues and the states
+        of the workers in the Prometheus text format."""
+    lines = []
+    for name, help_text in HISTOGRAMS.items():
+        lines += ["# HELP {} {}".format(name, help_text), "# TYPE {} histogram".format(name)]
+        fields = {k.decode("utf-8"): v.decode("utf-8") for k, v in CONN.hgetall("metrics:" + name).items()}
+        for field in sorted(fields, key=bucket_order):
+            labels, le = field.rsplit("|", 1)
+            value = fields[field]
+            if le in ("sum", "count"):
+                lines.append("{}_{}{{{}}} {}".format(name, le, labels, value))
+            else:
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, le, value))
+    for name, help_text in COUNTERS.items():
+        lines += ["# HELP {} {}".format(name, help_text), "# TYPE {} counter".format(name)]
+        for labels, value in sorted(CONN.hgetall("metrics:" + name).items()):
+            lines.append("{}{{{}}} {}".format(name, labels.decode("utf-8"), value.decode("utf-8")))
+
+    lines += ["# HELP crime_queue_depth Jobs waiting in queue.", "# TYPE crime_queue_depth gauge"]
+    for queue in queues:
+        lines.append('crime_queue_depth{{queue="{}"}} {}'.format(queue.name, len(queue)))
+    workers = Worker.all(connection=CONN)
+    busy = sum(1 for w in workers if w.get_state() == "busy")
+    lines += [
+        "# HELP crime_workers Workers by state.", "# TYPE crime_workers gauge",
+        'crime_workers{{state="busy"}} {}'.format(busy),
+        'crime_workers{{state="idle"}} {}'.format(len(workers) - busy),
+        "# HELP crime_worker_utilization Fraction of workers busy with a job.", "# TYPE crime_worker_utilization gauge",
+        "crime_worker_utilization {}".format(busy / len(workers) if workers else 0.0)
+    ]
+    return "\n".join(lines) + "\n"
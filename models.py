@@ -2,7 +2,7 @@
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, BigInteger, Integer, String, DateTime, \
-    ForeignKey, Float, LargeBinary
+    ForeignKey, Float, LargeBinary, Index
 from sqlalchemy.orm import relationship
 from geoalchemy2 import Geometry
 
@@ -27,9 +27,13 @@ class Blocks(BASE):
     """Block model for DB. Has information of city blocks for a related city
         id."""
     __tablename__ = 'block'
+    __table_args__ = (
+        Index('ix_block_cityid', 'cityid'),
+        Index('ix_block_shape', 'shape', postgresql_using='gist'),
+    )
     id            = Column(BigInteger, primary_key=True)
     cityid        = Column(BigInteger, ForeignKey('city.id'), nullable=False)
-    shape         = Column(Geometry(geometry_type='MULTIPOLYGON'), nullable=False)
+    shape         = Column(Geometry(geometry_type='MULTIPOLYGON', spatial_index=False), nullable=False)
     population    = Column(Integer, nullable=False)
     prediction    = Column(LargeBinary, nullable=True)
     city          = relationship("City", back_populates="blocks")
@@ -39,24 +43,38 @@ class ZipcodeGeom(BASE):
     """Zipcode geometry model for DB. Has information of zipcodes and related
         city id."""
     __tablename__ = 'zipcodegeom'
+    __table_args__ = (
+        Index('ix_zipcodegeom_cityid', 'cityid'),
+        Index('ix_zipcodegeom_shape', 'shape', postgresql_using='gist'),
+    )
     id            = Column(BigInteger, primary_key=True)
     cityid        = Column(BigInteger, ForeignKey('city.id'), nullable=False)
     zipcode       = Column(String, nullable=False, unique=True)
-    shape         = Column(Geometry(geometry_type='MULTIPOLYGON'), nullable=False)
+    shape         = Column(Geometry(geometry_type='MULTIPOLYGON', spatial_index=False), nullable=False)
     city          = relationship("City", back_populates="zipcodes")
 
 class Incident(BASE):
     """Incident model for DB. Has information of a specific crime, including
         where it took place, when it took place, and the type of crime that
-        occurred."""
+        occurred. Partitioned by month of datetime, see
+        utils.ensure_partitions."""
     __tablename__ = 'incident'
-    id            = Column(BigInteger, primary_key=True)
+    __table_args__ = (
+        Index('ix_incident_datetime', 'datetime', postgresql_using='brin'),
+        Index('ix_incident_city_datetime', 'cityid', 'datetime', 'hour', 'dow'),
+        Index('ix_incident_block_month', 'blockid', 'year', 'month'),
+        Index('ix_incident_crimetypeid', 'crimetypeid'),
+        Index('ix_incident_locdescid', 'locdescid'),
+        Index('ix_incident_location', 'location', postgresql_using='gist'),
+        {'postgresql_partition_by': 'RANGE (datetime)'}
+    )
+    id            = Column(BigInteger, primary_key=True, autoincrement=True)
     crimetypeid   = Column(BigInteger, ForeignKey('crimetype.id'), nullable=False)
     locdescid     = Column(BigInteger, ForeignKey('locdesctype.id'), nullable=False)
     cityid        = Column(BigInteger, ForeignKey('city.id'), nullable=False)
     blockid       = Column(BigInteger, ForeignKey('block.id'), nullable=False)
-    location      = Column(Geometry(geometry_type='POINT'), nullable=False)
-    datetime      = Column(DateTime, nullable=False)
+    location      = Column(Geometry(geometry_type='POINT', spatial_index=False), nullable=False)
+    datetime      = Column(DateTime, primary_key=True, nullable=False)
     hour          = Column(Integer, nullable=False)
     dow           = Column(Integer, nullable=False)
     month         = Column(Integer, nullable=False)
@@ -87,9 +105,31 @@ class LocationDescriptionType(BASE):
     incidents     = relationship("Incident", back_populates="locationdesc")
 
 
-class Job(BASE):
-    """Job model for DB and redis. Has information on the status and result of
-        redis queue job."""
-    __tablename__ = 'job'
-    id            = Column(BigInteger, primary_key=True)
-    result        = Column(String, nullable=False)
+class IncidentRollup(BASE):
+    """Incident rollup model for DB. Has the number of incidents and the sum of
+        their severities for every block, month, day of the week, hour, crime
+        type and location description. Kept up to date by
+        utils.refresh_rollup."""
+    __tablename__ = 'incidentrollup'
+    __table_args__ = (
+        Index('ix_incidentrollup_city_month', 'cityid', 'year', 'month'),
+    )
+    cityid        = Column(BigInteger, ForeignKey('city.id'), primary_key=True)
+    blockid       = Column(BigInteger, ForeignKey('block.id'), primary_key=True)
+    year          = Column(Integer, primary_key=True)
+    month         = Column(Integer, primary_key=True)
+    dow           = Column(Integer, primary_key=True)
+    hour          = Column(Integer, primary_key=True)
+    crimetypeid   = Column(BigInteger, ForeignKey('crimetype.id'), primary_key=True)
+    locdescid     = Column(BigInteger, ForeignKey('locdesctype.id'), primary_key=True)
+    count         = Column(Integer, nullable=False)
+    severity      = Column(BigInteger, nullable=False)
+
+
+class Watermark(BASE):
+    """Watermark model for DB. Has the highest incident id already processed by
+        an incremental job, such as the rollup refresh."""
+    __tablename__ = 'watermark'
+    name          = Column(String, primary_key=True)
+    incidentid    = Column(BigInteger, nullable=False)
+
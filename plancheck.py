@@ -0,0 +1,108 @@
+"""Checks the plans of the data and export queries against a DB with the
+    schema and some incidents loaded, such as a local Postgres:
+
+    DB_URI=postgresql://localhost/crime REDIS_URL=redis://localhost \\
+        python plancheck.py [--create-indexes] [cityid]
+
+    Sequential scans are disabled while planning, so a plan only scans
+    incident sequentially when no index can serve the query. Exits with
+    status 1 if any plan does."""
+
+from sqlalchemy import text
+
+import copy
+import itertools
+import sys
+
+from models import *
+from db import ENGINE, SESSION
+from utils import chart_queries, download_query
+
+
+# Date ranges checked, the second one with partial months at both ends
+DATE_RANGES = [("01/01/1900", "01/01/2100"), ("01/15/2018", "03/10/2018")]
+
+
+def create_indexes():
+    """Create the indexes declared on the models that are missing in DB."""
+    existing = {row[0] for row in SESSION.execute(text("SELECT indexname FROM pg_indexes;")).fetchall()}
+    SESSION.remove()
+    for table in BASE.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                print("Creating index " + index.name)
+                index.create(ENGINE)
+
+
+def seq_scans(plan):
+    """Get the incident relations scanned sequentially in a plan node and its
+        children."""
+    found = []
+    relation = plan.get("Relation Name", "")
+    if plan["Node Type"] == "Seq Scan" and (relation == "incident" or relation.startswith("incident_")):
+        found.append(relation)
+    for child in plan.get("Plans", []):
+        found += seq_scans(child)
+    return found
+
+
+def check(name, query, params=None):
+    """Explain a query and report whether its plan avoids sequential scans on
+        incident."""
+    if params is None:
+        RAW_CONN = ENGINE.raw_connection()
+        try:
+            cursor = RAW_CONN.cursor()
+            cursor.execute("SET enable_seqscan = off;")
+            cursor.execute("EXPLAIN (FORMAT JSON) " + query)
+            plan = cursor.fetchone()[0]
+            cursor.close()
+        finally:
+            RAW_CONN.close()
+    else:
+        SESSION.execute(text("SET enable_seqscan = off;"))
+        plan = SESSION.execute(text("EXPLAIN (FORMAT JSON) " + query), params).fetchone()[0]
+        SESSION.remove()
+    found = seq_scans(plan[0]["Plan"])
+    print("{:<6} {}{}".format("FAIL" if found else "ok", name, " (seq scan on " + ", ".join(found) + ")" if found else ""))
+    return not found
+
+
+def main(argv):
+    if "--create-indexes" in argv:
+        create_indexes()
+    args = [a for a in argv if not a.startswith("--")]
+    cityid = int(args[0]) if args else SESSION.query(City.id).order_by(City.id).first()[0]
+    blockid = SESSION.query(Blocks.id).filter(Blocks.cityid == cityid).order_by(Blocks.id).first()[0]
+    category = SESSION.query(CrimeType.category).order_by(CrimeType.id).first()[0]
+    locdesc = SESSION.query(LocationDescriptionType).order_by(LocationDescriptionType.id).first()
+    year = SESSION.execute(text("SELECT MAX(year) FROM incident WHERE cityid = :cityid;"), {"cityid": cityid}).fetchone()[0]
+    SESSION.remove()
+
+    passed = True
+    RAW_CONN = ENGINE.raw_connection()
+    cursor = RAW_CONN.cursor()
+    for (sdt, edt), use_block, use_dotw, use_crime, use_locdesc in itertools.product(DATE_RANGES, *[[False, True]] * 4):
+        name = "{}-{} block={} dotw={} crime={} locdesc={}".format(sdt, edt, use_block, use_dotw, use_crime, use_locdesc)
+        args = (
+            "0,6" if use_dotw else "",
+            category if use_crime else "",
+            [locdesc.key1 if use_locdesc else ""],
+            [locdesc.key2 if use_locdesc else ""],
+            [locdesc.key3 if use_locdesc else ""]
+        )
+        config_dict = {"cityid": cityid, "sdt": sdt, "edt": edt, "stime": 6, "etime": 20}
+        charts, query_frame, _ = chart_queries(config_dict, blockid if use_block else -1, *args)
+        for k in charts:
+            passed &= check("data " + k + " " + name, charts[k], config_dict)
+        passed &= check("data frame " + name, query_frame, config_dict)
+        if not use_block:
+            config_dict = {"cityid": cityid, "sdt": sdt, "edt": edt, "cyear": year, "stime": 6, "etime": 20}
+            passed &= check("download " + name, download_query(cursor, config_dict, *args))
+    cursor.close()
+    RAW_CONN.close()
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
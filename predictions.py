@@ -0,0 +1,104 @@
+"""Computes block predictions from incident aggregates and writes them to DB."""
+
+from sqlalchemy import text
+from psycopg2.extras import execute_values
+import numpy as np
+
+import json
+
+from models import *
+from db import SESSION, job_session
+from cache import CONN
+from utils import USE_ROLLUP, PREDICT_SHAPE, invalidate_predict, settled_max_id
+
+
+# Weight of each year of history relative to the following year
+YEAR_DECAY = 0.5
+
+
+@job_session
+def compute_predictions(cityid, changed_only=True):
+    """Compute the predictions of the blocks of a city as a blocks x 12 months
+        x 168 hours of the week tensor and write them with one batched update.
+        A prediction is the expected severity per person in an hour of the
+        week of a month, averaged over years with older years decayed by
+        YEAR_DECAY. With changed_only, only blocks with incidents added since
+        the last run are recomputed, unless the months with incidents in the
+        city changed: the weights of the years depend on them, so then every
+        block is."""
+    name = "prediction:{}".format(cityid)
+    SESSION.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name));"), {"name": name})
+    watermark = SESSION.query(Watermark).filter(Watermark.name == name).one_or_none()
+    if watermark is None:
+        watermark = Watermark(name=name, incidentid=0)
+        SESSION.add(watermark)
+    last_id = watermark.incidentid
+    if USE_ROLLUP:
+        # Only predict from incidents already folded into the rollup
+        query = "SELECT COALESCE(MAX(incidentid), 0) FROM watermark WHERE name = 'rollup';"
+        max_id = SESSION.execute(text(query)).fetchone()[0]
+    else:
+        max_id = settled_max_id()
+
+    source = "incidentrollup" if USE_ROLLUP else """(
+        SELECT incident.cityid, incident.blockid, incident.year, incident.month, incident.dow, incident.hour, crimetype.severity
+        FROM incident
+        INNER JOIN crimetype ON incident.crimetypeid = crimetype.id
+    )"""
+    query = """SELECT incident.year, incident.month
+        FROM """ + source + """ AS incident
+        WHERE incident.cityid = :cityid
+        GROUP BY incident.year, incident.month
+        ORDER BY incident.year, incident.month;"""
+    months = np.array(SESSION.execute(text(query), {"cityid": cityid}).fetchall(), dtype=np.int64).reshape((-1, 2))
+    months_key = "prediction:months:{}".format(cityid)
+    signature = json.dumps(months.tolist())
+    same_months = CONN.get(months_key) == signature.encode("utf-8")
+
+    if changed_only and last_id > 0 and same_months:
+        query = "SELECT DISTINCT blockid FROM incident WHERE cityid = :cityid AND id > :last_id AND id <= :max_id;"
+        params = {"cityid": cityid, "last_id": last_id, "max_id": max_id}
+    else:
+        query = "SELECT id FROM block WHERE cityid = :cityid;"
+        params = {"cityid": cityid}
+    blockids = sorted(row[0] for row in SESSION.execute(text(query), params).fetchall())
+    if not blockids:
+        watermark.incidentid = max_id
+        SESSION.commit()
+        CONN.set(months_key, signature)
+        return {"cityid": cityid, "blocks": 0}
+
+    query = """SELECT incident.blockid, incident.year, incident.month, incident.dow, incident.hour, SUM(incident.severity)::float8
+        FROM """ + source + """ AS incident
+        WHERE incident.cityid = :cityid AND incident.blockid = ANY(:blockids)
+        GROUP BY incident.blockid, incident.year, incident.month, incident.dow, incident.hour;"""
+    rows = np.array(SESSION.execute(text(query), {"cityid": cityid, "blockids": blockids}).fetchall(), dtype=np.float64).reshape((-1, 6))
+    query = "SELECT id, population FROM block WHERE id = ANY(:blockids) ORDER BY id;"
+    population = np.array([row[1] for row in SESSION.execute(text(query), {"blockids": blockids}).fetchall()], dtype=np.float64)
+
+    # Weight of every year, and total weight of the years covering each month
+    latest = months[:, 0].max() if len(months) else 0
+    covered = np.zeros(12)
+    np.add.at(covered, months[:, 1] - 1, YEAR_DECAY ** (latest - months[:, 0]))
+    severity = np.zeros((len(blockids),) + PREDICT_SHAPE)
+    if len(rows):
+        year, month, dow, hour = (rows[:, i].astype(np.int64) for i in range(1, 5))
+        block = np.searchsorted(blockids, rows[:, 0].astype(np.int64))
+        np.add.at(severity, (block, month - 1, dow * 24 + hour), rows[:, 5] * YEAR_DECAY ** (latest - year))
+    scale = np.outer(population, covered).reshape((len(blockids), 12, 1))
+    prediction = np.divide(severity, scale, out=np.zeros_like(severity), where=scale > 0)
+
+    cursor = SESSION.connection().connection.cursor()
+    execute_values(
+        cursor,
+        "UPDATE block SET prediction = data.prediction FROM (VALUES %s) AS data (id, prediction) WHERE block.id = data.id;",
+        [(blockid, prediction[i].astype(np.float64).tobytes()) for i, blockid in enumerate(blockids)],
+        template="(%s::bigint, %s::bytea)",
+        page_size=100
+    )
+    cursor.close()
+    watermark.incidentid = max_id
+    SESSION.commit()
+    CONN.set(months_key, signature)
+    invalidate_predict(cityid)
+    return {"cityid": cityid, "blocks": len(blockids)}
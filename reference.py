@@ -0,0 +1,79 @@
+"""Contains the in-process cache of the reference tables, which rarely
+    change: cities, crime types and location description types."""
+
+from decouple import config
+
+import json
+import threading
+import time
+
+from models import *
+from db import SESSION
+from cache import CONN, encode_body
+
+
+REFERENCE_TTL = config('REFERENCE_TTL', default=600, cast=int)
+
+# Bumped to make every process reload its reference tables
+VERSION_KEY = "reference:version"
+
+_lock   = threading.Lock()
+_tables = {}
+
+
+def city_string(city):
+    """Get the user friendly name of a city."""
+    if city.state:
+        return "{}, {}, {}".format(city.city, city.state, city.country).title()
+    return "{}, {}".format(city.city, city.country).title()
+
+
+def load_tables():
+    """Load the reference tables from DB."""
+    cities = [{"id": c.id, "string": city_string(c)} for c in SESSION.query(City).order_by(City.id).all()]
+    crimetypes = SESSION.query(CrimeType.id, CrimeType.category).all()
+    locdescs = SESSION.query(LocationDescriptionType).all()
+    return {
+        "cities": encode_body(json.dumps({"cities": cities, "error": "none"})),
+        "crimetype_ids": {r.category: r.id for r in crimetypes},
+        "crimetypes": {r.id: r.category for r in crimetypes},
+        "locdesc_ids": {(r.key1, r.key2, r.key3): r.id for r in locdescs},
+        "locdescs": {r.id: (r.key1, r.key2, r.key3) for r in locdescs}
+    }
+
+
+def reference(reload=False):
+    """Get the reference tables, reloading them once they are older than
+        REFERENCE_TTL seconds or were invalidated, or with reload. Holds the ETag and gzip
+        compressed body of /cities under "cities", the crime type categories
+        and location description key triples by id under "crimetypes" and
+        "locdescs", and the reverse lookups under "crimetype_ids" and
+        "locdesc_ids". The tables are replaced as a whole on reload, so a
+        caller keeps a consistent set while another thread reloads them."""
+    global _tables
+    version = CONN.get(VERSION_KEY)
+    with _lock:
+        if reload or not _tables or _tables["version"] != version or time.time() > _tables["expires"]:
+            tables = load_tables()
+            tables["version"] = version
+            tables["expires"] = time.time() + REFERENCE_TTL
+            _tables = tables
+        return _tables
+
+
+def invalidate_reference():
+    """Make every process reload its reference tables on next use."""
+    CONN.incr(VERSION_KEY)
+
+
+def crimetype_ids(categories):
+    """Resolve crime type categories to ids, dropping unknown ones."""
+    ids = reference()["crimetype_ids"]
+    return [ids[c] for c in categories if c in ids]
+
+
+def locdesc_ids(keys):
+    """Resolve location description key triples to ids, dropping unknown
+        ones."""
+    ids = reference()["locdesc_ids"]
+    return [ids[tuple(k)] for k in keys if tuple(k) in ids]
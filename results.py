@@ -0,0 +1,253 @@
+"""Contains result backends storing the output of queue jobs. Results are
+    written in chunks, each compressed as a separate gzip member, so that the
+    stored data is itself a valid gzip stream."""
+
+from decouple import config
+
+import gzip
+import os
+import time
+import zlib
+
+from cache import CONN
+
+
+RESULT_BACKEND    = config('RESULT_BACKEND', default='redis')
+RESULT_DIR        = config('RESULT_DIR', default='/tmp/results')
+RESULT_EXPIRY     = config('RESULT_EXPIRY', default=24 * 3600, cast=int)
+RESULT_CHUNK_SIZE = config('RESULT_CHUNK_SIZE', default=1024 * 1024, cast=int)
+# 0 stores chunks uncompressed, still framed as gzip members
+RESULT_COMPRESSLEVEL = config('RESULT_COMPRESSLEVEL', default=6, cast=int)
+
+
+def gunzip(chunks):
+    """Decompress an iterable of gzip stream chunks made of one or more gzip
+        members."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                chunk = b""
+    yield decompressor.flush()
+
+
+class ResultWriter(object):
+    """File-like object buffering written text or bytes and compressing it in
+        chunks of RESULT_CHUNK_SIZE bytes. Counts the bytes written in size and
+        the compressed bytes stored in stored. The result becomes visible to
+        readers only once the writer is closed without error."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.size = 0
+        self.stored = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.size += len(data)
+        self.buffer.extend(data)
+        while len(self.buffer) >= RESULT_CHUNK_SIZE:
+            self.compress(self.buffer[:RESULT_CHUNK_SIZE])
+            del self.buffer[:RESULT_CHUNK_SIZE]
+        return len(data)
+
+    def compress(self, data):
+        chunk = gzip.compress(bytes(data), RESULT_COMPRESSLEVEL)
+        self.stored += len(chunk)
+        self.append(chunk)
+
+    def close(self):
+        self.compress(self.buffer)
+        self.buffer = bytearray()
+        self.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class RedisWriter(ResultWriter):
+    """Writes compressed chunks to a temporary Redis list, renamed to the
+        result key when closed. The stored bytes are kept next to it under the
+        size key."""
+
+    def __init__(self, key, size_key):
+        super(RedisWriter, self).__init__()
+        self.key = key
+        self.size_key = size_key
+        self.tmp_key = key + ":tmp"
+        CONN.delete(self.tmp_key)
+
+    def append(self, chunk):
+        pipe = CONN.pipeline()
+        pipe.rpush(self.tmp_key, chunk)
+        pipe.expire(self.tmp_key, RESULT_EXPIRY)
+        pipe.execute()
+
+    def finish(self):
+        pipe = CONN.pipeline()
+        pipe.rename(self.tmp_key, self.key)
+        pipe.expire(self.key, RESULT_EXPIRY)
+        pipe.set(self.size_key, self.stored, ex=RESULT_EXPIRY)
+        pipe.execute()
+
+    def abort(self):
+        CONN.delete(self.tmp_key)
+
+
+class RedisBackend(object):
+    """Stores results as lists of compressed chunks in Redis, expiring
+        RESULT_EXPIRY seconds after they were last written or touched."""
+
+    def key(self, result_id):
+        return "payload:" + result_id
+
+    def size_key(self, result_id):
+        return "payload:" + result_id + ":size"
+
+    def writer(self, result_id):
+        return RedisWriter(self.key(result_id), self.size_key(result_id))
+
+    def exists(self, result_id):
+        return CONN.exists(self.key(result_id)) > 0
+
+    def size(self, result_id):
+        """Get the bytes a result takes in Redis, or 0 if it does not
+            exist."""
+        return int(CONN.get(self.size_key(result_id)) or 0)
+
+    def touch(self, result_id):
+        pipe = CONN.pipeline()
+        pipe.expire(self.key(result_id), RESULT_EXPIRY)
+        pipe.expire(self.size_key(result_id), RESULT_EXPIRY)
+        pipe.execute()
+
+    def delete(self, result_id):
+        CONN.delete(self.key(result_id), self.size_key(result_id))
+
+    def read_compressed(self, result_id):
+        """Get an iterator over the gzip stream of a result. Raises KeyError
+            if the result does not exist."""
+        key = self.key(result_id)
+        length = CONN.llen(key)
+        if length == 0:
+            raise KeyError(result_id)
+        def chunks():
+            for start in range(0, length, 8):
+                for chunk in CONN.lrange(key, start, start + 7):
+                    yield chunk
+        return chunks()
+
+    def read(self, result_id):
+        """Get an iterator over the decompressed chunks of a result. Raises
+            KeyError if the result does not exist."""
+        return gunzip(self.read_compressed(result_id))
+
+
+class FileWriter(ResultWriter):
+    """Writes compressed chunks to a temporary file, renamed to the result
+        path when closed."""
+
+    def __init__(self, path):
+        super(FileWriter, self).__init__()
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "wb")
+
+    def append(self, chunk):
+        self.file.write(chunk)
+
+    def finish(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class FileBackend(object):
+    """Stores results as gzip files in RESULT_DIR, removed RESULT_EXPIRY
+        seconds after they were last written or touched. The directory must be
+        shared by the web and worker processes."""
+
+    def __init__(self):
+        os.makedirs(RESULT_DIR, exist_ok=True)
+
+    def path(self, result_id):
+        return os.path.join(RESULT_DIR, result_id + ".gz")
+
+    def writer(self, result_id):
+        self.expire()
+        return FileWriter(self.path(result_id))
+
+    def expire(self):
+        """Remove results and abandoned temporary files past their expiry."""
+        limit = time.time() - RESULT_EXPIRY
+        for name in os.listdir(RESULT_DIR):
+            path = os.path.join(RESULT_DIR, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def exists(self, result_id):
+        return os.path.exists(self.path(result_id))
+
+    def size(self, result_id):
+        """Get the bytes a result takes on disk, or 0 if it does not
+            exist."""
+        try:
+            return os.path.getsize(self.path(result_id))
+        except OSError:
+            return 0
+
+    def touch(self, result_id):
+        try:
+            os.utime(self.path(result_id))
+        except OSError:
+            pass
+
+    def delete(self, result_id):
+        try:
+            os.remove(self.path(result_id))
+        except OSError:
+            pass
+
+    def read_compressed(self, result_id):
+        """Get an iterator over the gzip stream of a result. Raises KeyError
+            if the result does not exist."""
+        try:
+            f = open(self.path(result_id), "rb")
+        except FileNotFoundError:
+            raise KeyError(result_id)
+        def chunks():
+            with f:
+                for chunk in iter(lambda: f.read(RESULT_CHUNK_SIZE), b""):
+                    yield chunk
+        return chunks()
+
+    def read(self, result_id):
+        """Get an iterator over the decompressed chunks of a result. Raises
+            KeyError if the result does not exist."""
+        return gunzip(self.read_compressed(result_id))
+
+
+BACKENDS = {"redis": RedisBackend, "file": FileBackend}
+BACKEND  = BACKENDS[RESULT_BACKEND]()
+
+
+def read_text(result_id):
+    """Get a result as a string. Raises KeyError if it does not exist."""
+    return b"".join(BACKEND.read(result_id)).decode("utf-8")
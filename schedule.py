@@ -0,0 +1,27 @@
+"""Queues the cache warming of all cities, or of the given ones, e.g. from a
+    nightly scheduler after the data loads:
+
+    python schedule.py [cityid ...]"""
+
+from decouple import config
+from rq import Queue
+
+import sys
+
+from cache import CONN
+from warm import warm_caches
+
+
+# Seconds the warming of all cities may take
+WARM_TIMEOUT = config('WARM_TIMEOUT', default=3600, cast=int)
+
+
+def main(argv):
+    cityids = [int(a) for a in argv] or None
+    job = Queue('low', connection=CONN).enqueue(warm_caches, cityids, job_timeout=WARM_TIMEOUT)
+    print("Queued cache warming job " + job.id)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
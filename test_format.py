@@ -0,0 +1,195 @@
+"""Checks the formatting of chart rows into data job results against the
+    per-row implementation it replaced, on fixture rows shaped like the
+    results of the chart queries. Run with python -m unittest test_format."""
+
+import os
+
+os.environ.setdefault("DB_URI", "postgresql://localhost/crime")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+
+from decimal import Decimal
+import json
+import math
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from utils import CHART_ORDER, build_tree, cyclic_series, format_chart, severity_matrix
+
+
+SEVERITY = 3.5
+MULT_DOW, MULT_TIME, MONTHS_MULT = 7.0 / 3, 24.0 / 10, 1.0 / 14
+BLOCKID = 7
+
+NAMES = {
+    "crimetypes": {1: "THEFT", 2: "ARSON", 3: "BATTERY"},
+    "locdescs": {
+        1: ("STREET", "", ""),
+        2: ("RESIDENCE", "GARAGE", ""),
+        3: ("RESIDENCE", "PORCH", "FRONT"),
+        4: ("RESIDENCE", "GARAGE", "REAR")
+    }
+}
+
+# Rows of each chart query as psycopg2 returns them, sums as Decimal
+ROWS = {
+    "map": [
+        (Decimal("0.0125"), 9, 2018, 12), (Decimal("0.5"), 7, 2019, 2), (Decimal("0.02"), 7, 2018, 12),
+        (Decimal("1.75"), 12, 2019, 1), (Decimal("0.003"), 9, 2019, 2), (Decimal("0.25"), 12, 2018, 12)
+    ],
+    "date_all": [(Decimal("0.4"), 2018, 12), (Decimal("0.9"), 2019, 1), (Decimal("0.05"), 2019, 2)],
+    "time_all": [(Decimal("0.02"), 0), (Decimal("0.3"), 5), (Decimal("0.11"), 23), (Decimal("0.07"), 1)],
+    "dotw_all": [(Decimal("0.6"), 0), (Decimal("0.2"), 3), (Decimal("0.9"), 6)],
+    "date": [(Decimal("0.02"), 2018, 12), (Decimal("0.5"), 2019, 2)],
+    "time": [(Decimal("0.01"), 4)],
+    "dotw": [(Decimal("0.3"), 2)],
+    "crmtyp_all": [(14, 1), (3, 3), (9, 2)],
+    "locdesc_all": [(5, 2), (8, 1), (2, 3), (4, 4)],
+    "crmtyp": [(2, 3), (1, 1)],
+    "locdesc": [(1, 4), (3, 2)]
+}
+
+
+def baseline_rows(k, res):
+    """Turn the rows of chart k into the per-row dicts of the replaced
+        implementation."""
+    kind = k[:-len("_all")] if k.endswith("_all") else k
+    if kind == "map":
+        return [{"severity": math.pow(MULT_DOW * MULT_TIME * float(r[0]) / SEVERITY, 0.1), "blockid": int(r[1]), "month": int(r[3]), "year": int(r[2])} for r in res]
+    if kind == "date":
+        return [{"severity": math.pow(MULT_DOW * MULT_TIME * float(r[0]) / SEVERITY, 0.1), "month": int(r[2]), "year": int(r[1])} for r in res]
+    if kind == "time":
+        return [{"severity": math.pow(24 * MULT_DOW * MONTHS_MULT * float(r[0]) / SEVERITY, 0.1), "hour": int(r[1])} for r in res]
+    if kind == "dotw":
+        return [{"severity": math.pow(7 * MONTHS_MULT * MULT_TIME * float(r[0]) / SEVERITY, 0.1), "dow": int(r[1])} for r in res]
+    if kind == "crmtyp":
+        return [{"count": r[0], "category": NAMES["crimetypes"][r[1]]} for r in res]
+    return [dict(zip(["count", "locdesc1", "locdesc2", "locdesc3"], (r[0],) + NAMES["locdescs"][r[1]])) for r in res]
+
+
+def baseline_format(result, k, results, blockid):
+    """Add chart k to result the way the replaced implementation did. Block
+        time and day of the week charts read the rows of the all charts."""
+    kind = k[:-len("_all")] if k.endswith("_all") else k
+    target = result["main"]["all"] if k.endswith("_all") else result["main"].get(blockid)
+    if kind == "map":
+        map_df = pd.DataFrame(results["map"])
+        map_cross = pd.crosstab(map_df["blockid"], [map_df["year"], map_df["month"]], values=map_df["severity"], aggfunc='sum').fillna(0.0)
+        result["timeline"] = [{"year": c[0], "month": c[1]} for c in map_cross]
+        for i in map_cross.index:
+            result["other"].append({"id": i, "values": list(map_cross.loc[i, :].values)})
+    elif kind == "date":
+        target["values_date"] = [{"x": "{}/{}".format(c["month"], c["year"]), "y": c["severity"]} for c in results[k]]
+    elif kind == "time":
+        times = [{"x": i, "y": 0.0} for i in range(24)]
+        for c in results["time_all"]:
+            times[c["hour"]]["y"] = c["severity"]
+        target["values_time"] = [{"x": -1, "y": times[-1]["y"]}] + times + [{"x": 24, "y": times[0]["y"]}, {"x": 25, "y": times[1]["y"]}]
+    elif kind == "dotw":
+        dows = [{"x": i, "y": 0.0} for i in range(7)]
+        for c in results["dotw_all"]:
+            dows[c["dow"]]["y"] = c["severity"]
+        target["values_dow"] = [{"x": -1, "y": dows[-1]["y"]}] + dows + [{"x": 7, "y": dows[0]["y"]}]
+    elif kind == "crmtyp":
+        data = {}
+        for r in results[k]:
+            data[r["category"]] = r["count"]
+        target["values_type"] = {"name": "Crime Type for All Data", "children": [{"name": k1, "count": data[k1]} for k1 in data]}
+    elif kind == "locdesc":
+        data = {}
+        for r in results[k]:
+            data.setdefault(r["locdesc1"], {}).setdefault(r["locdesc2"], {})[r["locdesc3"]] = r["count"]
+        n_data = {"name": "Location Description for All Data", "children": []}
+        for k1 in data:
+            t_d = {"name": k1, "children": []}
+            for k2 in data[k1]:
+                t_e = {"name": "{} | {}".format(k1, k2), "children": []}
+                for k3 in data[k1][k2]:
+                    t_e["children"].append({"name": "{} | {} | {}".format(k1, k2, k3), "count": data[k1][k2][k3]})
+                t_d["children"].append(t_e)
+            n_data["children"].append(t_d)
+        target["values_locdesc"] = n_data
+
+
+def empty_result(blockid):
+    keys = ["values_date", "values_time", "values_dow", "values_type", "values_locdesc"]
+    return {"error": "none", "main": {"all": {k: [] for k in keys}, blockid: {}}, "other": [], "timeline": []}
+
+
+class FormatTest(unittest.TestCase):
+
+    def assertSameJSON(self, first, second, path="result"):
+        """Assert that two results serialize to the same JSON, up to a
+            relative 1e-12 on floats."""
+        self.assertEqual(type(first), type(second), path)
+        if isinstance(first, dict):
+            self.assertEqual(list(first), list(second), path)
+            for k in first:
+                self.assertSameJSON(first[k], second[k], "{}.{}".format(path, k))
+        elif isinstance(first, list):
+            self.assertEqual(len(first), len(second), path)
+            for i, (a, b) in enumerate(zip(first, second)):
+                self.assertSameJSON(a, b, "{}[{}]".format(path, i))
+        elif isinstance(first, float):
+            self.assertTrue(math.isclose(first, second, rel_tol=1e-12), "{}: {} != {}".format(path, first, second))
+        else:
+            self.assertEqual(first, second, path)
+
+    def test_format_chart_matches_baseline(self):
+        context = {
+            "severity": SEVERITY,
+            "mults": {
+                "map": MULT_DOW * MULT_TIME,
+                "date": MULT_DOW * MULT_TIME,
+                "time": 24 * MULT_DOW * MONTHS_MULT,
+                "dotw": 7 * MONTHS_MULT * MULT_TIME
+            },
+            "map_format": "full",
+            "names": NAMES,
+            "series": {}
+        }
+        result, expected, results = empty_result(BLOCKID), empty_result(BLOCKID), {}
+        for k in CHART_ORDER:
+            format_chart(result, k, ROWS[k], BLOCKID, context)
+            results[k] = baseline_rows(k, ROWS[k])
+            baseline_format(expected, k, results, BLOCKID)
+        self.assertSameJSON(json.loads(json.dumps(result)), json.loads(json.dumps(expected)))
+
+    def test_format_chart_reloads_names(self):
+        stale = {"crimetypes": NAMES["crimetypes"], "locdescs": {i: NAMES["locdescs"][i] for i in (1, 2, 3)}}
+        context = {"names": stale}
+        result = empty_result(BLOCKID)
+        with mock.patch("utils.reference", return_value=NAMES) as reference:
+            format_chart(result, "locdesc_all", ROWS["locdesc_all"], BLOCKID, context)
+            format_chart(result, "crmtyp_all", ROWS["crmtyp_all"], BLOCKID, context)
+        reference.assert_called_once_with(reload=True)
+        self.assertIs(context["names"], NAMES)
+        garage = result["main"]["all"]["values_locdesc"]["children"][0]["children"][0]
+        self.assertEqual(garage["children"][1], {"name": "RESIDENCE | GARAGE | REAR", "count": 4})
+
+    def test_severity_matrix(self):
+        blocks, timeline, matrix = severity_matrix([9, 7, 9, 7], [2019, 2018, 2018, 2019], [1, 12, 12, 1], np.array([1.0, 2.0, 3.0, 4.0]))
+        self.assertEqual(blocks, [7, 9])
+        self.assertEqual(timeline, [(2018, 12), (2019, 1)])
+        self.assertEqual(matrix.tolist(), [[2.0, 4.0], [3.0, 1.0]])
+
+    def test_severity_matrix_empty(self):
+        blocks, timeline, matrix = severity_matrix((), (), (), np.zeros(0))
+        self.assertEqual((blocks, timeline, matrix.shape), ([], [], (0, 0)))
+
+    def test_cyclic_series(self):
+        series = cyclic_series(np.array([1.0, 2.0, 3.0]), 1)
+        self.assertEqual(series, [{"x": -1, "y": 3.0}, {"x": 0, "y": 1.0}, {"x": 1, "y": 2.0}, {"x": 2, "y": 3.0}, {"x": 3, "y": 1.0}])
+
+    def test_build_tree(self):
+        tree = build_tree("Root", [(1, "A", "x"), (2, "B", "y"), (3, "A", "z")])
+        self.assertEqual(tree, {"name": "Root", "children": [
+            {"name": "A", "children": [{"name": "A | x", "count": 1}, {"name": "A | z", "count": 3}]},
+            {"name": "B", "children": [{"name": "B | y", "count": 2}]}
+        ]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+"""Checks the split of data job date ranges into incident rollup months and
+    residual incident ranges, its assembly into the chart queries, and the
+    charts computed in frame mode against hand-computed rows. Run with
+    python -m unittest test_queries."""
+
+import os
+
+os.environ.setdefault("DB_URI", "postgresql://localhost/crime")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+
+from datetime import datetime
+import math
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from utils import FRAME_CHARTS, FRAME_COLUMNS, chart_queries, frame_chart, query_rollup, query_unrolled, split_range
+
+
+def config(sdt, edt):
+    return {"sdt": sdt, "edt": edt, "stime": 0, "etime": 23}
+
+
+@mock.patch("utils.USE_ROLLUP", True)
+class SplitRangeTest(unittest.TestCase):
+
+    def test_partial_months_at_both_ends(self):
+        rollup, residual = split_range(datetime(2018, 3, 15), datetime(2018, 7, 10))
+        self.assertEqual(rollup, ((2018, 4), (2018, 7)))
+        self.assertEqual(residual, [
+            (datetime(2018, 3, 15), datetime(2018, 4, 1), False),
+            (datetime(2018, 7, 1), datetime(2018, 7, 10), True)
+        ])
+
+    def test_whole_first_month(self):
+        rollup, residual = split_range(datetime(2018, 3, 1), datetime(2018, 7, 10))
+        self.assertEqual(rollup, ((2018, 3), (2018, 7)))
+        self.assertEqual(residual, [(datetime(2018, 7, 1), datetime(2018, 7, 10), True)])
+
+    def test_december_rollover(self):
+        rollup, residual = split_range(datetime(2018, 12, 15), datetime(2019, 3, 5))
+        self.assertEqual(rollup, ((2019, 1), (2019, 3)))
+        self.assertEqual(residual[0], (datetime(2018, 12, 15), datetime(2019, 1, 1), False))
+
+    def test_ends_in_december(self):
+        rollup, residual = split_range(datetime(2018, 10, 1), datetime(2018, 12, 31))
+        self.assertEqual(rollup, ((2018, 10), (2018, 12)))
+        self.assertEqual(residual, [(datetime(2018, 12, 1), datetime(2018, 12, 31), True)])
+
+    def test_within_one_month(self):
+        rollup, residual = split_range(datetime(2019, 2, 3), datetime(2019, 2, 20))
+        self.assertIsNone(rollup)
+        self.assertEqual(residual, [(datetime(2019, 2, 3), datetime(2019, 2, 20), True)])
+
+    def test_across_one_month_boundary(self):
+        rollup, residual = split_range(datetime(2019, 1, 15), datetime(2019, 2, 10))
+        self.assertIsNone(rollup)
+        self.assertEqual(residual, [(datetime(2019, 1, 15), datetime(2019, 2, 10), True)])
+
+    def test_rollup_off(self):
+        with mock.patch("utils.USE_ROLLUP", False):
+            rollup, residual = split_range(datetime(2018, 3, 15), datetime(2018, 7, 10))
+        self.assertIsNone(rollup)
+        self.assertEqual(residual, [(datetime(2018, 3, 15), datetime(2018, 7, 10), True)])
+
+
+@mock.patch("utils.USE_ROLLUP", True)
+class ChartQueriesTest(unittest.TestCase):
+
+    def test_rollup_and_residual_ranges(self):
+        config_dict = config("03/15/2018", "07/10/2018")
+        charts, query_frame, filters = chart_queries(config_dict, -1, "", "", [""], [""], [""])
+        self.assertEqual(filters, ["time", "pop"])
+        self.assertEqual(sorted(charts), ["crmtyp_all", "date_all", "dotw_all", "locdesc_all", "map", "time_all"])
+        self.assertEqual(
+            (config_dict["rollup_sy"], config_dict["rollup_sm"], config_dict["rollup_ey"], config_dict["rollup_em"]),
+            (2018, 4, 2018, 7)
+        )
+        self.assertEqual((config_dict["residual_s0"], config_dict["residual_e0"]), (datetime(2018, 3, 15), datetime(2018, 4, 1)))
+        self.assertEqual((config_dict["residual_s1"], config_dict["residual_e1"]), (datetime(2018, 7, 1), datetime(2018, 7, 10)))
+        self.assertEqual((config_dict["rollup_s"], config_dict["rollup_e"]), (datetime(2018, 4, 1), datetime(2018, 7, 1)))
+        for query in list(charts.values()) + [query_frame]:
+            self.assertIn(query_rollup, query)
+            self.assertIn("(incident.datetime >= :residual_s0 AND incident.datetime < :residual_e0)", query)
+            self.assertIn("(incident.datetime >= :residual_s1 AND incident.datetime <= :residual_e1)", query)
+            self.assertIn("(incident.datetime >= :rollup_s AND incident.datetime < :rollup_e AND " + query_unrolled + ")", query)
+
+    def test_rollup_off(self):
+        config_dict = config("03/15/2018", "07/10/2018")
+        with mock.patch("utils.USE_ROLLUP", False):
+            charts, query_frame, _ = chart_queries(config_dict, 7, "", "", [""], [""], [""])
+        self.assertFalse([k for k in config_dict if k.startswith("rollup")])
+        self.assertEqual((config_dict["residual_s0"], config_dict["residual_e0"]), (datetime(2018, 3, 15), datetime(2018, 7, 10)))
+        self.assertNotIn("residual_s1", config_dict)
+        self.assertEqual(config_dict["blockid"], 7)
+        self.assertIn("date", charts)
+        for query in list(charts.values()) + [query_frame]:
+            self.assertNotIn(query_rollup, query)
+            self.assertNotIn(query_unrolled, query)
+            self.assertIn("(incident.datetime >= :residual_s0 AND incident.datetime <= :residual_e0)", query)
+
+    def test_block_charts_filter_the_block(self):
+        config_dict = config("01/01/2018", "12/31/2018")
+        charts, _, _ = chart_queries(config_dict, 7, "1,3", "", [""], [""], [""])
+        self.assertEqual(config_dict["dotw"], [1, 3])
+        for k in ("date", "time", "dotw", "crmtyp", "locdesc"):
+            self.assertIn("incident.blockid = :blockid", charts[k])
+            self.assertNotIn("incident.blockid = :blockid", charts[k + "_all"])
+        self.assertNotIn("incident.dow = ANY(:dotw)", charts["dotw_all"])
+        self.assertIn("incident.dow = ANY(:dotw)", charts["time_all"])
+
+
+# Pre-grouped rows of blocks 1 (population 100) and 2 (population 400). With
+# hours 0 to 20, days 0 and 3, crime types 1 and 2 and location descriptions 1
+# and 2, only the first and third pass every filter, and each other row fails
+# one: the hour, the day, the crime type and the location description.
+FRAME = pd.DataFrame([
+    (1, 2019, 1, 0, 5, 1, 1, 100, 2, 6.0),
+    (1, 2019, 1, 3, 22, 2, 1, 100, 1, 4.0),
+    (2, 2019, 1, 0, 10, 1, 2, 400, 3, 9.0),
+    (2, 2019, 2, 5, 10, 2, 1, 400, 1, 2.0),
+    (2, 2019, 2, 3, 8, 3, 2, 400, 4, 8.0),
+    (1, 2019, 2, 0, 12, 1, 3, 100, 5, 10.0)
+], columns=FRAME_COLUMNS)
+
+# Severity of a chart of all blocks: the severity over the population of the
+# blocks weighted by their incident counts, times the number of blocks
+SEVERITY_ALL = 15.0 / ((2 * 100 + 3 * 400) / 5.0 * 2)
+
+FRAME_ROWS = {
+    "map": [(6.0 / 100, 1, 2019, 1), (9.0 / 400, 2, 2019, 1)],
+    "date_all": [(SEVERITY_ALL, 2019, 1)],
+    "time_all": [(6.0 / 100, 5), (9.0 / 400, 10), (4.0 / 100, 22)],
+    "dotw_all": [(SEVERITY_ALL, 0), (2.0 / 400, 5)],
+    "crmtyp_all": [(5, 1), (4, 3)],
+    "locdesc_all": [(2, 1), (3, 2), (5, 3)],
+    "date": [(9.0 / 400, 2019, 1)],
+    "time": [(9.0 / 400, 10)],
+    "dotw": [(9.0 / 400, 0), (2.0 / 400, 5)],
+    "crmtyp": [(3, 1), (4, 3)],
+    "locdesc": [(3, 2)]
+}
+
+
+class FrameChartTest(unittest.TestCase):
+
+    def masks(self, blockid):
+        return {
+            "time": (FRAME["hour"] >= 0) & (FRAME["hour"] <= 20),
+            "dow": FRAME["dow"].isin([0, 3]),
+            "crime": FRAME["crimetypeid"].isin([1, 2]),
+            "locdesc": FRAME["locdescid"].isin([1, 2]),
+            "block": FRAME["blockid"] == blockid
+        }
+
+    def assertRows(self, rows, expected, chart):
+        self.assertEqual([r[1:] for r in rows], [r[1:] for r in expected], chart)
+        for r, e in zip(rows, expected):
+            self.assertTrue(math.isclose(r[0], e[0], rel_tol=1e-12), "{}: {} != {}".format(chart, r, e))
+
+    def test_charts(self):
+        masks = self.masks(2)
+        for k in FRAME_CHARTS:
+            self.assertRows(frame_chart(FRAME, masks, *FRAME_CHARTS[k]), FRAME_ROWS[k], k)
+
+    def test_counts_stay_integers(self):
+        rows = frame_chart(FRAME, self.masks(2), *FRAME_CHARTS["crmtyp_all"])
+        self.assertEqual([type(r[0]) for r in rows], [int, int])
+
+    def test_no_rows_left(self):
+        self.assertEqual(frame_chart(FRAME, self.masks(99), *FRAME_CHARTS["date"]), [])
+        self.assertEqual(len(frame_chart(FRAME, self.masks(99), *FRAME_CHARTS["date_all"])), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,70 +1,204 @@
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from decouple import config
+from rq import get_current_job
 from geomet import wkb, wkt
+from psycopg2.errors import DuplicateTable, UniqueViolation
 import pandas as pd
+import numpy as np
+import orjson
 
+import base64
+import copy
 import json
 import datetime
 import math
+import struct
 import io
 import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from models import *
+from db import ENGINE, SESSION, job_session
+from cache import CONN, NORMALIZER_TTL, get_or_set, publish_job, add_partial, data_generation, invalidate_results
+from results import BACKEND, RESULT_CHUNK_SIZE
+from reference import reference, crimetype_ids, locdesc_ids
+from metrics import timed_job, stage, query, collect, current, record_query
 
 
-DB_URI  = config('DB_URI')
-ENGINE  = create_engine(DB_URI)
-Session = sessionmaker(bind=ENGINE)
-SESSION = Session()
+# Answer whole months of the chart queries from the incident rollup
+USE_ROLLUP = config('USE_ROLLUP', default=True, cast=bool)
 
-def get_download(config_dict, dotw, crimetypes, locdesc1, locdesc2, locdesc3):
-    query_base    = " FROM incident "
-    query_city    = "incident.cityid = {cityid}"
-    query_date    = "incident.datetime >= TO_DATE('{sdt}', 'MM/DD/YYYY') AND datetime <= TO_DATE('{edt}', 'MM/DD/YYYY')"
-    query_year    = "incident.year = {cyear}"
-    query_time    = "incident.hour >= {stime} AND hour <= {etime}"
-    query_dotw    = "incident.dow = ANY({dotw})"
-    query_crmtyp  = "crimetype.category = ANY({crimetypes})"
-    query_locdesc = "(locdesctype.key1, locdesctype.key2, locdesctype.key3) = ANY({lockeys})"
-    query_join    = "INNER JOIN crimetype ON incident.crimetypeid = crimetype.id INNER JOIN locdesctype ON incident.locdescid = locdesctype.id INNER JOIN city ON incident.cityid = city.id AND "
+# Compute the charts from one pre-grouped query ("frame") or one query per chart ("sql")
+CHART_MODE = config('CHART_MODE', default='sql')
+# Chart queries run concurrently in sql mode
+CHART_WORKERS = config('CHART_WORKERS', default=4, cast=int)
 
-    base_list = [query_city, query_date, query_year, query_time]
-    outputs   = ", ".join(["city.city", "city.state", "city.country", "incident.datetime", "ST_XMAX(incident.location) AS latitude", "ST_YMAX(incident.location) AS longitude", "crimetype.category", "locdesctype.key1 AS location_key1", "locdesctype.key2 AS location_key2", "locdesctype.key3 AS location_key3"])
-    if dotw != "":
-        config_dict["dotw"] = dotw.split(",")
-        base_list.append(query_dotw)
-    if crimetypes != "":
-        config_dict["crimetypes"] = ["'{}'".format(x) for x in crimetypes.split(",")]
-        config_dict["crimetypes"] = "ARRAY[{}]".format(", ".join(config_dict["crimetypes"]))
-        base_list.append(query_crmtyp)
-    if locdesc1 != [""] and locdesc2 != [""] and locdesc3 != [""] and len(locdesc1) == len(locdesc2) and len(locdesc2) == len(locdesc3):
-        config_dict["lockeys"] = []
-        for i in range(len(locdesc1)):
-            config_dict["lockeys"].append("('{}', '{}', '{}')".format(locdesc1[i], locdesc2[i], locdesc3[i]))
-        config_dict["lockeys"] = "ARRAY[{}]".format(", ".join(config_dict["lockeys"]))
-        base_list.append(query_locdesc)
-    query = "COPY (SELECT " + outputs + query_base + query_join + (" AND ".join(base_list)).format(**config_dict) +") TO STDOUT WITH DELIMITER ',' CSV;"
-    
-    with io.StringIO() as f:
-        RAW_CONN = create_engine(DB_URI).raw_connection()
-        cursor = RAW_CONN.cursor()
-        cursor.copy_expert(query, f)
-        cursor.close()
-        RAW_CONN.close()
-        f.seek(0)
-        job = Job(result=f.getvalue())
-        SESSION.add(job)
-        SESSION.commit()
-        return job.id
+# Coordinate order and SRID of stored geometries. Locations are stored as
+# (latitude, longitude), see get_download.
+COORDS_ORDER = config('COORDS_ORDER', default='latlon')
+GEOM_SRID    = config('GEOM_SRID', default=0, cast=int)
+
+# Encodings of block predictions, with the dtype and code of binary ones
+PREDICT_FORMATS = {
+    "json": None,
+    "float32": (np.float32, 0),
+    "float16": (np.float16, 1),
+    "uint8": (np.uint8, 2)
+}
+PREDICT_SHAPE = (12, 168)
+
+# Encodings of the block x month map of data jobs: nested lists ("full") or a
+# base64 encoded matrix of a dtype
+MAP_FORMATS = {
+    "full": None,
+    "float32": np.float32,
+    "uint16": np.uint16,
+    "uint8": np.uint8
+}
+
+# Serializers of data job results: the stdlib json module, or orjson ("fast")
+JSON_ENCODERS = ["json", "fast"]
 
-def get_data(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3):
+# Half the width of the world in web mercator meters
+MERCATOR_EXTENT = 20037508.342789244
+
+ROLLUP_COLUMNS = "cityid, blockid, year, month, dow, hour, crimetypeid, locdescid"
+
+query_rollup = """SELECT
+        incidentrollup.cityid,
+        incidentrollup.blockid,
+        incidentrollup.year,
+        incidentrollup.month,
+        incidentrollup.dow,
+        incidentrollup.hour,
+        incidentrollup.crimetypeid,
+        incidentrollup.locdescid,
+        incidentrollup.count,
+        incidentrollup.severity
+    FROM incidentrollup
+    WHERE incidentrollup.cityid = :cityid
+        AND (incidentrollup.year, incidentrollup.month) >= (:rollup_sy, :rollup_sm)
+        AND (incidentrollup.year, incidentrollup.month) < (:rollup_ey, :rollup_em)"""
+
+# Incidents added since the last rollup refresh, read from incident even in
+# rollup months
+query_unrolled = "incident.id > (SELECT COALESCE(MAX(incidentid), 0) FROM watermark WHERE name = 'rollup')"
+
+query_residual = """SELECT
+        incident.cityid,
+        incident.blockid,
+        incident.year,
+        incident.month,
+        incident.dow,
+        incident.hour,
+        incident.crimetypeid,
+        incident.locdescid,
+        COUNT(*) AS count,
+        SUM(crimetype.severity) AS severity
+    FROM incident
+    INNER JOIN crimetype ON incident.crimetypeid = crimetype.id
+    WHERE incident.cityid = :cityid AND ({ranges})
+    GROUP BY
+        incident.cityid,
+        incident.blockid,
+        incident.year,
+        incident.month,
+        incident.dow,
+        incident.hour,
+        incident.crimetypeid,
+        incident.locdescid"""
+
+
+FRAME_COLUMNS = ["blockid", "year", "month", "dow", "hour", "crimetypeid", "locdescid", "population", "count", "severity"]
+
+# Order in which charts are computed and reported: the map, then the date,
+# time and day of the week series, then the crime type and location trees.
+# Block time and day of the week charts are formatted from their all charts.
+CHART_ORDER = ["map", "date_all", "time_all", "dotw_all", "date", "time", "dotw", "crmtyp_all", "locdesc_all", "crmtyp", "locdesc"]
+
+# Field of the result each kind of chart other than the map fills in
+CHART_FIELDS = {
+    "date": "values_date",
+    "time": "values_time",
+    "dotw": "values_dow",
+    "crmtyp": "values_type",
+    "locdesc": "values_locdesc"
+}
+
+# Group columns, value, filter left out and block filter of each chart in frame mode
+FRAME_CHARTS = {
+    "map": (["blockid", "year", "month"], "severity", None, False),
+    "date_all": (["year", "month"], "severity_all", None, False),
+    "time_all": (["hour"], "severity_all", "time", False),
+    "dotw_all": (["dow"], "severity_all", "dow", False),
+    "crmtyp_all": (["crimetypeid"], "count", "crime", False),
+    "locdesc_all": (["locdescid"], "count", "locdesc", False),
+    "date": (["year", "month"], "severity", None, True),
+    "time": (["hour"], "severity", "time", True),
+    "dotw": (["dow"], "severity", "dow", True),
+    "crmtyp": (["crimetypeid"], "count", "crime", True),
+    "locdesc": (["locdescid"], "count", "locdesc", True)
+}
+
+
+def frame_chart(frame, masks, group, value, exclude, block):
+    """Compute one chart from the pre-grouped frame. Rows are masked with every
+        filter mask except exclude, and the block mask only if block is set.
+        Returns rows shaped like the results of the matching chart query."""
+    mask = pd.Series(True, index=frame.index)
+    for k in masks:
+        if k != exclude and (k != "block" or block):
+            mask &= masks[k]
+    frame = frame[mask]
+    if frame.empty:
+        return []
+    grouped = frame.assign(weighted=frame["count"] * frame["population"]).groupby(group)
+    if value == "count":
+        values = grouped["count"].sum()
+    elif value == "severity":
+        values = grouped["severity"].sum() / grouped["population"].mean()
+    else:
+        values = grouped["severity"].sum() / (grouped["weighted"].sum() / grouped["count"].sum() * grouped["blockid"].nunique())
+    return [(v,) + (i if isinstance(i, tuple) else (i,)) for v, i in zip(values.tolist(), values.index.tolist())]
+
+
+def split_range(sdt, edt):
+    """Split the inclusive datetime range [sdt, edt] into the whole months that
+        can be read from the incident rollup and the partial months at either
+        end that have to be read from incident. Returns the rollup range as a
+        half-open ((year, month), (year, month)) pair, or None, and a list of
+        (start, end, end inclusive) incident ranges."""
+    first = datetime.datetime(sdt.year, sdt.month, 1)
+    if first < sdt:
+        first = datetime.datetime(sdt.year + sdt.month // 12, sdt.month % 12 + 1, 1)
+    last = datetime.datetime(edt.year, edt.month, 1)
+    if not USE_ROLLUP or first >= last:
+        return None, [(sdt, edt, True)]
+    residual = []
+    if sdt < first:
+        residual.append((sdt, first, False))
+    residual.append((last, edt, True))
+    return ((first.year, first.month), (last.year, last.month)), residual
+
+
+def compute_severity():
+    """Get the highest severity per person of any block in any hour of any
+        month across all cities. Used to normalize chart severities."""
+    source = """SELECT incident.blockid, incident.year, incident.month, incident.dow, incident.hour, crimetype.severity
+            FROM incident
+            INNER JOIN crimetype ON incident.crimetypeid = crimetype.id"""
+    if USE_ROLLUP:
+        source = """SELECT blockid, year, month, dow, hour, severity FROM incidentrollup
+            UNION ALL
+            """ + source + " WHERE " + query_unrolled
     query = """SELECT MAX(categories.severity)
         FROM (
-            SELECT SUM(crimetype.severity)/AVG(block.population) AS severity
-            FROM incident
+            SELECT SUM(incident.severity)/AVG(block.population) AS severity
+            FROM (""" + source + """) AS incident
             INNER JOIN block ON incident.blockid = block.id
-            INNER JOIN crimetype ON incident.crimetypeid = crimetype.id
                 AND block.population > 0
             GROUP BY
                 incident.blockid,
@@ -73,84 +207,596 @@ def get_data(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc
                 incident.dow,
                 incident.hour
         ) AS categories;"""
-    severity = float(SESSION.execute(text(query)).fetchone()[0]) * 24 * 7
+    return float(SESSION.execute(text(query)).fetchone()[0])
+
+
+def compute_month_count(sdt, edt):
+    """Get the number of months with incidents between the sdt and edt dates."""
     query = """SELECT COUNT(*) FROM (
         SELECT COUNT(*)
         FROM incident
-        WHERE incident.datetime >= TO_DATE(:sdt, 'MM/DD/YYYY') AND incident.datetime <= TO_DATE(:edt, 'MM/DD/YYYY')
+        WHERE incident.datetime >= :sdate AND incident.datetime <= :edate
         GROUP BY incident.year, incident.month
     ) AS month_count;"""
-    months_mult = 1.0 / SESSION.execute(text(query), {"sdt": config_dict["sdt"], "edt": config_dict["edt"]}).fetchone()[0]
+    params = {
+        "sdate": datetime.datetime.strptime(sdt, "%m/%d/%Y"),
+        "edate": datetime.datetime.strptime(edt, "%m/%d/%Y")
+    }
+    return SESSION.execute(text(query), params).fetchone()[0]
+
+
+def ensure_partitions(conn, months):
+    """Create the incident partitions of the given (year, month) pairs that do
+        not exist yet, on the raw connection conn. Creating a partition locks
+        incident exclusively, so each one is committed at once rather than
+        held through the load that needs it; conn must have no work of its
+        own pending. A partition another process created meanwhile is taken
+        as it is."""
+    cursor = conn.cursor()
+    for year, month in sorted(set(months)):
+        name = "incident_y{:04d}m{:02d}".format(year, month)
+        start = datetime.date(year, month, 1)
+        end = datetime.date(year + month // 12, month % 12 + 1, 1)
+        cursor.execute("SELECT to_regclass(%s);", (name,))
+        if cursor.fetchone()[0] is not None:
+            conn.rollback()
+            continue
+        try:
+            cursor.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF incident FOR VALUES FROM ('{}') TO ('{}');".format(
+                name, start.isoformat(), end.isoformat()
+            ))
+            conn.commit()
+        except (DuplicateTable, UniqueViolation):
+            # Created by a concurrent ingest between the check and the create
+            conn.rollback()
+    cursor.close()
+
+
+def settled_max_id():
+    """Get the highest incident id, once no insert still running can add an id
+        below it. Ids are handed out before commit, so an ingest that has not
+        committed yet may hold ids below those of one that has. Takes a SHARE
+        lock on incident until the end of the transaction, which waits for the
+        running inserts and holds off new ones."""
+    SESSION.execute(text("LOCK TABLE incident IN SHARE MODE;"))
+    return SESSION.execute(text("SELECT COALESCE(MAX(id), 0) FROM incident;")).fetchone()[0]
+
+
+@job_session
+def refresh_rollup(full=False):
+    """Fold incidents added since the last refresh into the incident rollup.
+        Incidents are assumed to only ever be appended, and are folded in up
+        to the settled_max_id. With full, the rollup is rebuilt from
+        scratch and a new generation of the data is started, for incidents
+        changed in place."""
+    query = """INSERT INTO incidentrollup (""" + ROLLUP_COLUMNS + """, count, severity)
+        SELECT
+            incident.cityid,
+            incident.blockid,
+            incident.year,
+            incident.month,
+            incident.dow,
+            incident.hour,
+            incident.crimetypeid,
+            incident.locdescid,
+            COUNT(*),
+            SUM(crimetype.severity)
+        FROM incident
+        INNER JOIN crimetype ON incident.crimetypeid = crimetype.id
+        WHERE incident.id > :last_id AND incident.id <= :max_id
+        GROUP BY
+            incident.cityid,
+            incident.blockid,
+            incident.year,
+            incident.month,
+            incident.dow,
+            incident.hour,
+            incident.crimetypeid,
+            incident.locdescid
+        ON CONFLICT (""" + ROLLUP_COLUMNS + """) DO UPDATE SET
+            count = incidentrollup.count + EXCLUDED.count,
+            severity = incidentrollup.severity + EXCLUDED.severity;"""
+    SESSION.execute(text("SELECT pg_advisory_xact_lock(hashtext('incidentrollup'));"))
+    if full:
+        SESSION.execute(text("DELETE FROM incidentrollup;"))
+        SESSION.query(Watermark).filter(Watermark.name == "rollup").delete()
+    watermark = SESSION.query(Watermark).filter(Watermark.name == "rollup").one_or_none()
+    if watermark is None:
+        watermark = Watermark(name="rollup", incidentid=0)
+        SESSION.add(watermark)
+    last_id = watermark.incidentid
+    max_id = settled_max_id()
+    if max_id > last_id:
+        SESSION.execute(text(query), {"last_id": last_id, "max_id": max_id})
+        watermark.incidentid = max_id
+    SESSION.commit()
+    if full:
+        invalidate_results()
+    return max_id - last_id
+
+def build_shapes(cityid, zoom=None):
+    """Get the serialized shapes response of a city, or None if the city does
+        not exist. With zoom, shapes are simplified to about a pixel at that
+        map zoom level."""
+    city = SESSION.query(City.location).filter(City.id == cityid).one_or_none()
+    if city is None:
+        return None
+    params = {"cityid": cityid, "tolerance": None if zoom is None else 360.0 / (256 * 2 ** zoom)}
+    shape = "ST_AsBinary(shape)" if zoom is None else "ST_AsBinary(ST_SimplifyPreserveTopology(shape, :tolerance))"
+    query_blocks = "SELECT id, " + shape + " FROM block WHERE cityid = :cityid ORDER BY id;"
+    query_zipcodes = "SELECT zipcode, " + shape + " FROM zipcodegeom WHERE cityid = :cityid ORDER BY zipcode;"
+    blocks = [{
+        "id": row[0],
+        "shape": wkb.loads(bytes(row[1]))["coordinates"]
+    } for row in SESSION.execute(text(query_blocks), params).fetchall()]
+    zipcodes = [{
+        "zipcode": row[0],
+        "shape": wkb.loads(bytes(row[1]))["coordinates"]
+    } for row in SESSION.execute(text(query_zipcodes), params).fetchall()]
+    return json.dumps({
+        "error": "none",
+        "blocks": blocks,
+        "zipcodes": zipcodes,
+        "citylocation": wkb.loads(bytes(city[0].data))["coordinates"]
+    })
+
+
+def build_tile(cityid, z, x, y):
+    """Get the Mapbox vector tile z/x/y of a city, with a blocks and a
+        zipcodes layer."""
+    size = 2 * MERCATOR_EXTENT / 2 ** z
+    n = 2.0 ** z
+    lon_min, lon_max = x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+    lat_max = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    lat_min = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    params = {
+        "cityid": cityid,
+        "xmin": -MERCATOR_EXTENT + x * size,
+        "ymax": MERCATOR_EXTENT - y * size,
+        "xmax": -MERCATOR_EXTENT + (x + 1) * size,
+        "ymin": MERCATOR_EXTENT - (y + 1) * size,
+        "srid": GEOM_SRID
+    }
+    if COORDS_ORDER == "latlon":
+        params.update({"bxmin": lat_min, "bymin": lon_min, "bxmax": lat_max, "bymax": lon_max})
+        lonlat = "ST_FlipCoordinates(shape)"
+    else:
+        params.update({"bxmin": lon_min, "bymin": lat_min, "bxmax": lon_max, "bymax": lat_max})
+        lonlat = "shape"
+    layer = """SELECT ST_AsMVT(tile, '{name}', 4096, 'geom') FROM (
+            SELECT {key}, ST_AsMVTGeom(ST_Transform(ST_SetSRID({lonlat}, 4326), 3857), ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 3857), 4096, 64, true) AS geom
+            FROM {table}
+            WHERE cityid = :cityid AND shape && ST_MakeEnvelope(:bxmin, :bymin, :bxmax, :bymax, :srid)
+        ) AS tile WHERE geom IS NOT NULL"""
+    query = "SELECT COALESCE((" + layer.format(name="blocks", table="block", key="id", lonlat=lonlat) + "), ''::bytea) || COALESCE((" + layer.format(name="zipcodes", table="zipcodegeom", key="zipcode", lonlat=lonlat) + "), ''::bytea);"
+    return bytes(SESSION.execute(text(query), params).fetchone()[0])
+
 
+def build_predict(cityid, fmt):
+    """Get the encoded block predictions of a city. The json format maps block
+        ids to 12 x 168 nested lists. Binary formats are little-endian and
+        made of a 24 byte header (b"PRED", version 2 as uint8, dtype code as
+        uint8, 2 reserved bytes, block count as uint32, months and hours of the
+        week as uint16, offset and scale as float32), the block ids as uint64
+        and the predictions of each block in row-major order. uint8 values
+        decode to offset + value * scale."""
+    query = "SELECT id, prediction FROM block WHERE cityid = :cityid AND prediction IS NOT NULL ORDER BY id;"
+    rows = SESSION.execute(text(query), {"cityid": cityid}).fetchall()
+    ids = np.array([row[0] for row in rows], dtype=np.uint64)
+    values = np.zeros((len(rows),) + PREDICT_SHAPE, dtype=np.float64)
+    for i, row in enumerate(rows):
+        values[i] = np.frombuffer(bytes(row[1]), dtype=np.float64).reshape(PREDICT_SHAPE)
+    if fmt == "json":
+        return json.dumps({"error": "none", "prediction": {int(k): v for k, v in zip(ids, values.tolist())}})
+    dtype, code = PREDICT_FORMATS[fmt]
+    data, offset, scale = quantize(values, dtype)
+    header = struct.pack("<4sBBxxIHHff", b"PRED", 2, code, len(ids), PREDICT_SHAPE[0], PREDICT_SHAPE[1], offset, scale)
+    return header + ids.astype("<u8").tobytes() + data
+
+
+def quantize(values, dtype):
+    """Encode an array of floats as little-endian dtype values. Unsigned
+        integer dtypes span the range of the values linearly and decode to
+        offset + value * scale. Returns the bytes, offset and scale."""
+    offset, scale = 0.0, 1.0
+    if np.issubdtype(dtype, np.integer):
+        if values.size:
+            offset = float(values.min())
+            scale = float(values.max() - offset) / np.iinfo(dtype).max or 1.0
+        values = np.rint((values - offset) / scale)
+    return values.astype(np.dtype(dtype).newbyteorder("<")).tobytes(), offset, scale
+
+
+def encode_json(value, encoder):
+    """Serialize a data job result with the stdlib json module, or with
+        orjson for the "fast" encoder."""
+    if encoder == "fast":
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value)
+
+
+def invalidate_predict(cityid):
+    """Remove the cached encoded block predictions of a city."""
+    CONN.delete(*["predict:{}:{}".format(cityid, fmt) for fmt in PREDICT_FORMATS])
+
+
+def download_query(cursor, config_dict, dotw, crimetypes, locdesc1, locdesc2, locdesc3):
+    """Build the query of an export job, with its parameters bound by cursor.
+        Dates are compared directly with datetime so that only the partitions
+        of the requested months are scanned."""
     query_base    = " FROM incident "
-    query_city    = "incident.cityid = :cityid"
-    query_date    = "incident.datetime >= TO_DATE(:sdt, 'MM/DD/YYYY') AND incident.datetime <= TO_DATE(:edt, 'MM/DD/YYYY')"
+    query_city    = "incident.cityid = %(cityid)s"
+    query_date    = "incident.datetime >= %(sdate)s AND incident.datetime <= %(edate)s"
+    query_year    = "incident.datetime >= %(ystart)s AND incident.datetime < %(yend)s"
+    query_time    = "incident.hour >= %(stime)s AND incident.hour <= %(etime)s"
+    query_dotw    = "incident.dow = ANY(%(dotw)s)"
+    query_crmtyp  = "incident.crimetypeid = ANY(%(crimetypeids)s)"
+    query_locdesc = "incident.locdescid = ANY(%(locdescids)s)"
+    query_join    = "INNER JOIN crimetype ON incident.crimetypeid = crimetype.id INNER JOIN locdesctype ON incident.locdescid = locdesctype.id INNER JOIN city ON incident.cityid = city.id AND "
+
+    params = {
+        "cityid": config_dict["cityid"],
+        "sdate": datetime.datetime.strptime(config_dict["sdt"], "%m/%d/%Y"),
+        "edate": datetime.datetime.strptime(config_dict["edt"], "%m/%d/%Y"),
+        "ystart": datetime.datetime(config_dict["cyear"], 1, 1),
+        "yend": datetime.datetime(config_dict["cyear"] + 1, 1, 1),
+        "stime": config_dict["stime"],
+        "etime": config_dict["etime"]
+    }
+    base_list = [query_city, query_date, query_year, query_time]
+    outputs   = ", ".join(["city.city", "city.state", "city.country", "incident.datetime", "ST_XMAX(incident.location) AS latitude", "ST_YMAX(incident.location) AS longitude", "crimetype.category", "locdesctype.key1 AS location_key1", "locdesctype.key2 AS location_key2", "locdesctype.key3 AS location_key3"])
+    if dotw != "":
+        params["dotw"] = [int(x) for x in dotw.split(",")]
+        base_list.append(query_dotw)
+    if crimetypes != "":
+        params["crimetypeids"] = crimetype_ids(crimetypes.split(","))
+        base_list.append(query_crmtyp)
+    if locdesc1 != [""] and locdesc2 != [""] and locdesc3 != [""] and len(locdesc1) == len(locdesc2) and len(locdesc2) == len(locdesc3):
+        params["locdescids"] = locdesc_ids(zip(locdesc1, locdesc2, locdesc3))
+        base_list.append(query_locdesc)
+    query = "SELECT " + outputs + query_base + query_join + " AND ".join(base_list)
+    return cursor.mogrify(query, params).decode("utf-8")
+
+
+@job_session
+@timed_job("download")
+def get_download(config_dict, dotw, crimetypes, locdesc1, locdesc2, locdesc3):
+    result_id = str(uuid.uuid4())
+    RAW_CONN = ENGINE.raw_connection()
+    try:
+        cursor = RAW_CONN.cursor()
+        query = "COPY (" + download_query(cursor, config_dict, dotw, crimetypes, locdesc1, locdesc2, locdesc3) + ") TO STDOUT WITH DELIMITER ',' CSV;"
+        with stage("copy") as copy_stage, BACKEND.writer(result_id) as writer:
+            start = time.perf_counter()
+            cursor.copy_expert(query, writer, size=RESULT_CHUNK_SIZE)
+            record_query("copy", time.perf_counter() - start, cursor.rowcount)
+            copy_stage.size = writer.size
+        cursor.close()
+    finally:
+        RAW_CONN.close()
+    return result_id
+
+
+def repeatable_read(conn):
+    """Begin a repeatable read transaction on a connection. The pre-ping of the
+        pool leaves its SELECT 1 transaction open on checkout, so it is rolled
+        back first: the isolation level must be set before any query."""
+    conn.connection.rollback()
+    trans = conn.begin()
+    conn.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;"))
+    return trans
+
+
+def chart_rows(charts, config_dict, order):
+    """Run the chart queries of a data job, yielding their names and rows in
+        order. With CHART_WORKERS above 1 the queries run concurrently, each on
+        its own connection. Every connection imports the snapshot of a lead
+        repeatable read transaction, so all charts see the same data."""
+    if CHART_WORKERS <= 1:
+        for k in order:
+            with query("chart " + k):
+                rows = SESSION.execute(text(charts[k]), config_dict).fetchall()
+            yield k, rows
+        return
+
+    timings = current()
+    lead = ENGINE.connect()
+    trans = repeatable_read(lead)
+    try:
+        with query("snapshot"):
+            snapshot = lead.execute(text("SELECT pg_export_snapshot();")).fetchone()[0]
+
+        def run(k):
+            with collect(timings), query("chart " + k), ENGINE.connect() as conn:
+                with repeatable_read(conn):
+                    conn.execute(text("SET TRANSACTION SNAPSHOT :snapshot;"), {"snapshot": snapshot})
+                    return conn.execute(text(charts[k]), config_dict).fetchall()
+
+        with ThreadPoolExecutor(max_workers=CHART_WORKERS) as pool:
+            futures = {k: pool.submit(run, k) for k in order}
+            for k in order:
+                yield k, futures[k].result()
+    finally:
+        trans.rollback()
+        lead.close()
+
+
+def chart_output(result, k, blockid):
+    """Get the part of the result of a data job that chart k filled in."""
+    if k == "map":
+        return {"other": result["other"], "timeline": result["timeline"]}
+    kind = k[:-len("_all")] if k.endswith("_all") else k
+    target = "all" if k.endswith("_all") else blockid
+    return {"main": {target: {CHART_FIELDS[kind]: result["main"][target][CHART_FIELDS[kind]]}}}
+
+
+def report_progress(job, done, total, chart, output):
+    """Publish the progress of a data job in its meta and the output of the
+        chart it just finished in its partial result, and notify subscribers
+        of the job. Each chart output is stored once, so a large map is not
+        written again with every later chart."""
+    if job is None:
+        return
+    add_partial(job.id, chart, output)
+    job.meta["progress"] = {"done": done, "total": total, "chart": chart}
+    job.save_meta()
+    publish_job(job.id, "progress")
+
+
+def chart_columns(rows, width):
+    """Split the rows of a chart query into width column tuples."""
+    return list(zip(*rows)) if rows else [()] * width
+
+
+def scale_severity(values, mult, severity):
+    """Scale the summed severities of a chart by mult over the normalizing
+        severity, flattened with a 0.1 power."""
+    return np.power(mult * np.asarray(values, dtype=np.float64) / severity, 0.1)
+
+
+def severity_matrix(blockids, years, months, values):
+    """Scatter the rows of the map chart into a dense blocks x months matrix.
+        Returns the sorted block ids, the sorted (year, month) timeline and the
+        matrix, zero where a block has no row in a month."""
+    blocks, block_index = np.unique(np.asarray(blockids, dtype=np.int64), return_inverse=True)
+    periods, period_index = np.unique(np.asarray(years, dtype=np.int64) * 12 + np.asarray(months, dtype=np.int64) - 1, return_inverse=True)
+    matrix = np.zeros((len(blocks), len(periods)))
+    np.add.at(matrix, (block_index, period_index), values)
+    return blocks.tolist(), [(p // 12, p % 12 + 1) for p in periods.tolist()], matrix
+
+
+def cyclic_series(values, after):
+    """Format a series over the hours or days of the week for a chart, wrapped
+        with the last value before the first and after values past the
+        end."""
+    n = len(values)
+    xs = np.arange(-1, n + after)
+    return [{"x": x, "y": y} for x, y in zip(xs.tolist(), values[xs % n].tolist())]
+
+
+def build_tree(name, rows):
+    """Build a chart tree from (count, key, ...) rows. Rows are nested by
+        their keys in order of first appearance. Each node is named by its keys
+        joined with " | " and leaves hold the count."""
+    root = {}
+    for row in rows:
+        node = root
+        for key in row[1:-1]:
+            node = node.setdefault(key, {})
+        node[row[-1]] = row[0]
+
+    def children(node, path):
+        nodes = []
+        for key, value in node.items():
+            label = " | ".join(path + [key])
+            if isinstance(value, dict):
+                nodes.append({"name": label, "children": children(value, path + [key])})
+            else:
+                nodes.append({"name": label, "count": value})
+        return nodes
+    return {"name": name, "children": children(root, [])}
+
+
+def chart_names(context, table, rows):
+    """Get a reference table naming the ids of (count, id) chart rows. The
+        reference tables are reloaded if the rows hold ids added after they
+        were loaded, such as location descriptions of a running ingest."""
+    if any(r[1] not in context["names"][table] for r in rows):
+        context["names"] = reference(reload=True)
+    return context["names"][table]
+
+
+def format_chart(result, k, rows, blockid, context):
+    """Add chart k of a data job to its result from the rows of its query.
+        context holds the normalizing "severity", the severity multiplier of
+        each kind of chart under "mults", the map encoding under "map_format",
+        the reference tables under "names" and the time and day of the week
+        series of the all charts under "series". Block time and day of the
+        week charts are formatted from the series of their all charts."""
+    kind = k[:-len("_all")] if k.endswith("_all") else k
+    if k.endswith("_all") or k == "map":
+        target = result["main"]["all"]
+    else:
+        target = result["main"][blockid]
+
+    if kind == "map":
+        values, blockids, years, months = chart_columns(rows, 4)
+        blocks, timeline, matrix = severity_matrix(blockids, years, months, scale_severity(values, context["mults"]["map"], context["severity"]))
+        result["timeline"] = [{"year": year, "month": month} for year, month in timeline]
+        dtype = MAP_FORMATS[context["map_format"]]
+        if dtype is None:
+            result["other"].extend({"id": b, "values": v} for b, v in zip(blocks, matrix.tolist()))
+        else:
+            data, offset, scale = quantize(matrix, dtype)
+            result["other"] = {
+                "format": context["map_format"],
+                "ids": blocks,
+                "shape": list(matrix.shape),
+                "offset": offset,
+                "scale": scale,
+                "values": base64.b64encode(data).decode("ascii")
+            }
+    elif kind == "date":
+        values, years, months = chart_columns(rows, 3)
+        ys = scale_severity(values, context["mults"]["date"], context["severity"]).tolist()
+        target["values_date"] = [{"x": "{}/{}".format(int(month), int(year)), "y": y} for year, month, y in zip(years, months, ys)]
+    elif kind in ("time", "dotw"):
+        size, key = (24, "values_time") if kind == "time" else (7, "values_dow")
+        if k.endswith("_all"):
+            values, index = chart_columns(rows, 2)
+            series = np.zeros(size)
+            series[np.asarray(index, dtype=np.intp)] = scale_severity(values, context["mults"][kind], context["severity"])
+            context["series"][kind] = series
+        target[key] = cyclic_series(context["series"][kind], 2 if kind == "time" else 1)
+    elif kind == "crmtyp":
+        names = chart_names(context, "crimetypes", rows)
+        target["values_type"] = build_tree("Crime Type for All Data", [(r[0], names[r[1]]) for r in rows])
+    elif kind == "locdesc":
+        names = chart_names(context, "locdescs", rows)
+        target["values_locdesc"] = build_tree("Location Description for All Data", [(r[0],) + names[r[1]] for r in rows])
+
+
+def chart_queries(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3):
+    """Build the chart queries of a data job. Adds their parameters to
+        config_dict. Returns the queries by chart name, the query of the
+        pre-grouped frame used in frame mode and the names of the filters
+        applied."""
+    rollup, residual = split_range(
+        datetime.datetime.strptime(config_dict["sdt"], "%m/%d/%Y"),
+        datetime.datetime.strptime(config_dict["edt"], "%m/%d/%Y")
+    )
+    facts = []
+    if rollup:
+        config_dict["rollup_sy"], config_dict["rollup_sm"] = rollup[0]
+        config_dict["rollup_ey"], config_dict["rollup_em"] = rollup[1]
+        facts.append(query_rollup)
+    residual_list = []
+    for i, (start, end, inclusive) in enumerate(residual):
+        config_dict["residual_s{}".format(i)] = start
+        config_dict["residual_e{}".format(i)] = end
+        residual_list.append("(incident.datetime >= :residual_s{0} AND incident.datetime {1} :residual_e{0})".format(i, "<=" if inclusive else "<"))
+    if rollup:
+        config_dict["rollup_s"] = datetime.datetime(*rollup[0], 1)
+        config_dict["rollup_e"] = datetime.datetime(*rollup[1], 1)
+        residual_list.append("(incident.datetime >= :rollup_s AND incident.datetime < :rollup_e AND " + query_unrolled + ")")
+    facts.append(query_residual.format(ranges=" OR ".join(residual_list)))
+
+    query_base    = " FROM (" + " UNION ALL ".join(facts) + ") AS incident "
     query_time    = "incident.hour >= :stime AND incident.hour <= :etime"
     query_block   = "incident.blockid = :blockid"
     query_dotw    = "incident.dow = ANY(:dotw)"
-    query_crmtyp  = "crimetype.category = ANY(:crimetypes)"
-    query_locdesc = "ARRAY [locdesctype.key1, locdesctype.key2, locdesctype.key3] = ANY(:lockeys)"
+    query_crmtyp  = "incident.crimetypeid = ANY(:crimetypeids)"
+    query_locdesc = "incident.locdescid = ANY(:locdescids)"
     query_pop     = "block.population > 0"
-    query_join    = "INNER JOIN block ON incident.blockid = block.id INNER JOIN crimetype ON incident.crimetypeid = crimetype.id INNER JOIN locdesctype ON incident.locdescid = locdesctype.id AND "
+    query_join    = "INNER JOIN block ON incident.blockid = block.id AND "
+    q_severity    = "SUM(incident.severity)/AVG(block.population), "
+    q_sev_all     = "SUM(incident.severity)/(SUM(incident.count * block.population)::numeric/SUM(incident.count)*COUNT(DISTINCT incident.blockid)), "
+    q_count       = "SUM(incident.count)::bigint, "
+    q_frame       = "incident.blockid, incident.year, incident.month, incident.dow, incident.hour, incident.crimetypeid, incident.locdescid, block.population, SUM(incident.count)::bigint, SUM(incident.severity)::float8"
+    q_frame_end   = "incident.blockid, incident.year, incident.month, incident.dow, incident.hour, incident.crimetypeid, incident.locdescid, block.population"
     q_base_end    = "incident.blockid, incident.year, incident.month"
     q_date_end    = "incident.year, incident.month"
     q_time_end    = "incident.hour"
     q_dotw_end    = "incident.dow"
-    q_crmtyp_end  = "crimetype.category"
-    q_locdesc_end = "locdesctype.key1, locdesctype.key2, locdesctype.key3"
-    mult_time = 24.0 / min(config_dict["etime"] - config_dict["stime"] + 1, 24)
-    mult_dow = 1
+    q_crmtyp_end  = "incident.crimetypeid"
+    q_locdesc_end = "incident.locdescid"
 
-
-    base_list = {"city": query_city, "date": query_date, "time": query_time, "pop": query_pop}
+    base_list = {"time": query_time, "pop": query_pop}
     if dotw != "":
         config_dict["dotw"] = [int(x) for x in dotw.split(",")]
         base_list["dow"] = query_dotw
-        mult_dow = 7.0 / len(config_dict["dotw"])
     if crimetypes != "":
-        config_dict["crimetypes"] = crimetypes.split(",")
+        config_dict["crimetypeids"] = crimetype_ids(crimetypes.split(","))
         base_list["crime"] = query_crmtyp
     if locdesc1 != [""] and locdesc2 != [""] and locdesc3 != [""] and len(locdesc1) == len(locdesc2) and len(locdesc2) == len(locdesc3):
-        config_dict["lockeys"] = []
-        for i, _ in enumerate(locdesc1):
-            config_dict["lockeys"].append([locdesc1[i], locdesc2[i], locdesc3[i]])
+        config_dict["locdescids"] = locdesc_ids(zip(locdesc1, locdesc2, locdesc3))
         base_list["locdesc"] = query_locdesc
     if blockid != -1:
         config_dict["blockid"] = blockid
 
-    funcs = {
-        "map": lambda res: [{"severity": math.pow(mult_dow * mult_time * float(r[0]) / severity, 0.1), "blockid": int(r[1]), "month": int(r[3]), "year": int(r[2])} for r in res],
-        "date": lambda res: [{"severity": math.pow(mult_dow * mult_time * float(r[0]) / severity, 0.1), "month": int(r[2]), "year": int(r[1])} for r in res],
-        "time": lambda res: [{"severity": math.pow(24 * mult_dow * months_mult * float(r[0]) / severity, 0.1), "hour": int(r[1])} for r in res],
-        "dotw": lambda res: [{"severity": math.pow(7 * months_mult * mult_time * float(r[0]) / severity, 0.1), "dow": int(r[1])} for r in res],
-        "crmtyp": lambda res: [{"count": r[0], "category": r[1]} for r in res],
-        "locdesc": lambda res: [{"count": r[0], "locdesc1": r[1], "locdesc2": r[2], "locdesc3": r[3]} for r in res],
-        "date_all": lambda res: [{"severity": math.pow(mult_dow * mult_time * float(r[0]) / severity, 0.1), "month": int(r[2]), "year": int(r[1])} for r in res],
-        "time_all": lambda res: [{"severity": math.pow(24 * mult_dow * months_mult * float(r[0]) / severity, 0.1), "hour": int(r[1])} for r in res],
-        "dotw_all": lambda res: [{"severity": math.pow(7 * months_mult * mult_time * float(r[0]) / severity, 0.1), "dow": int(r[1])} for r in res],
-        "crmtyp_all": lambda res: [{"count": r[0], "category": r[1]} for r in res],
-        "locdesc_all": lambda res: [{"count": r[0], "locdesc1": r[1], "locdesc2": r[2], "locdesc3": r[3]} for r in res]
-    }
-    
     charts = {
-        "map": "SELECT SUM(crimetype.severity)/AVG(block.population), " + q_base_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list]) + " GROUP BY " + q_base_end,
-        "date_all": "SELECT SUM(crimetype.severity)/(AVG(block.population)*COUNT(DISTINCT incident.blockid)), " + q_date_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list]) + " GROUP BY " + q_date_end,
-        "time_all": "SELECT SUM(crimetype.severity)/(AVG(block.population)*COUNT(DISTINCT incident.blockid)), " + q_time_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "time"]) + " GROUP BY " + q_time_end,
-        "dotw_all": "SELECT SUM(crimetype.severity)/(AVG(block.population)*COUNT(DISTINCT incident.blockid)), " + q_dotw_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "dow"]) + " GROUP BY " + q_dotw_end,
-        "crmtyp_all": "SELECT COUNT(*), " + q_crmtyp_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "crime"]) + " GROUP BY " + q_crmtyp_end,
-        "locdesc_all": "SELECT COUNT(*), " + q_locdesc_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "locdesc"]) + " GROUP BY " + q_locdesc_end,
+        "map": "SELECT " + q_severity + q_base_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list]) + " GROUP BY " + q_base_end,
+        "date_all": "SELECT " + q_sev_all + q_date_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list]) + " GROUP BY " + q_date_end,
+        "time_all": "SELECT " + q_sev_all + q_time_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "time"]) + " GROUP BY " + q_time_end,
+        "dotw_all": "SELECT " + q_sev_all + q_dotw_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "dow"]) + " GROUP BY " + q_dotw_end,
+        "crmtyp_all": "SELECT " + q_count + q_crmtyp_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "crime"]) + " GROUP BY " + q_crmtyp_end,
+        "locdesc_all": "SELECT " + q_count + q_locdesc_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "locdesc"]) + " GROUP BY " + q_locdesc_end,
     }
     if blockid != -1:
-        charts["date"] = "SELECT SUM(crimetype.severity)/AVG(block.population), " + q_date_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list]+[query_block]) + " GROUP BY " + q_date_end
-        charts["time"] = "SELECT SUM(crimetype.severity)/AVG(block.population), " + q_time_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "time"]+[query_block]) + " GROUP BY " + q_time_end
-        charts["dotw"] = "SELECT SUM(crimetype.severity)/AVG(block.population), " + q_dotw_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "dow"]+[query_block]) + " GROUP BY " + q_dotw_end
-        charts["crmtyp"] = "SELECT COUNT(*), " + q_crmtyp_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "crime"]+[query_block]) + " GROUP BY " + q_crmtyp_end
-        charts["locdesc"] = "SELECT COUNT(*), " + q_locdesc_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "locdesc"]+[query_block]) + " GROUP BY " + q_locdesc_end
-    results = {}
-    for k in charts:
-        res = SESSION.execute(text(charts[k]), config_dict).fetchall()
-        results[k] = funcs[k](res)
-    
+        charts["date"] = "SELECT " + q_severity + q_date_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list]+[query_block]) + " GROUP BY " + q_date_end
+        charts["time"] = "SELECT " + q_severity + q_time_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "time"]+[query_block]) + " GROUP BY " + q_time_end
+        charts["dotw"] = "SELECT " + q_severity + q_dotw_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "dow"]+[query_block]) + " GROUP BY " + q_dotw_end
+        charts["crmtyp"] = "SELECT " + q_count + q_crmtyp_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "crime"]+[query_block]) + " GROUP BY " + q_crmtyp_end
+        charts["locdesc"] = "SELECT " + q_count + q_locdesc_end + query_base + query_join + " AND ".join([base_list[k] for k in base_list if k != "locdesc"]+[query_block]) + " GROUP BY " + q_locdesc_end
+    query_frame = "SELECT " + q_frame + query_base + query_join + query_pop + " GROUP BY " + q_frame_end
+    return charts, query_frame, list(base_list)
+
+
+def plan_rows(plan):
+    """Get the rows the planner expects the scans of a plan node and its
+        children to return."""
+    if "Plans" not in plan:
+        return plan["Plan Rows"]
+    return sum(plan_rows(child) for child in plan["Plans"])
+
+
+def estimate_data_rows(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3):
+    """Estimate the rows the queries of a data job read, from the plan of its
+        map query (or its frame query in frame mode) times the number of
+        queries."""
+    config_dict = copy.deepcopy(config_dict)
+    charts, query_frame, _ = chart_queries(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3)
+    if CHART_MODE == "frame":
+        query, n = query_frame, 1
+    else:
+        query, n = charts["map"], len(charts)
+    plan = SESSION.execute(text("EXPLAIN (FORMAT JSON) " + query), config_dict).fetchone()[0]
+    return plan_rows(plan[0]["Plan"]) * n
+
+
+def normalizer_keys(config_dict):
+    """Get the cache keys of the severity and month count normalizers of a
+        data job."""
+    generation = data_generation()
+    return "normalizer:severity:{}".format(generation), "normalizer:months:{}:{}:{}".format(generation, config_dict["sdt"], config_dict["edt"])
+
+
+def normalizers_cached(config_dict):
+    """Tell whether both normalizers of a data job are cached, so that it runs
+        its chart queries only."""
+    keys = normalizer_keys(config_dict)
+    return CONN.exists(*keys) == len(keys)
+
+
+def compute_data(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3, map_format="full", encoder="json", job=None):
+    """Compute the result of a data request and store it in the result
+        backend, reporting progress to job if set. Returns the result id."""
+    with stage("normalizers"), query("normalizers"):
+        severity_key, months_key = normalizer_keys(config_dict)
+        severity = get_or_set(severity_key, compute_severity, NORMALIZER_TTL) * 24 * 7
+        months_mult = 1.0 / get_or_set(
+            months_key,
+            lambda: compute_month_count(config_dict["sdt"], config_dict["edt"]),
+            NORMALIZER_TTL
+        )
+
+    charts, query_frame, filters = chart_queries(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3)
+    mult_time = 24.0 / min(config_dict["etime"] - config_dict["stime"] + 1, 24)
+    mult_dow = 7.0 / len(config_dict["dotw"]) if "dow" in filters else 1
+
+    context = {
+        "severity": severity,
+        "mults": {
+            "map": mult_dow * mult_time,
+            "date": mult_dow * mult_time,
+            "time": 24 * mult_dow * months_mult,
+            "dotw": 7 * months_mult * mult_time
+        },
+        "map_format": map_format,
+        "names": reference(),
+        "series": {}
+    }
+
     result = {
         "error": "none",
         "main": {
@@ -165,108 +811,41 @@ def get_data(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc
         "other": [],
         "timeline": []
     }
-    
-    map_df = pd.DataFrame(results["map"])
-    map_cross = pd.crosstab(map_df["blockid"], [map_df["year"], map_df["month"]], values=map_df["severity"], aggfunc='sum').fillna(0.0)
-    result["timeline"] = [{"year": c[0], "month": c[1]} for c in map_cross]
-    for i in map_cross.index:
-        result["other"].append({
-            "id": i,
-            "values": list(map_cross.loc[i,:].values)
-        })
-    
-    result["main"]["all"]["values_date"] = [{"x": "{}/{}".format(c["month"], c["year"]), "y": c["severity"]} for c in results["date_all"]]
-    all_times = [{"x": i, "y": 0.0} for i in range(24)]
-    for c in results["time_all"]:
-        all_times[c["hour"]]["y"] = c["severity"]
-    all_times = [{"x": -1, "y": all_times[-1]["y"]}] + all_times + [{"x": 24, "y": all_times[0]["y"]}, {"x": 25, "y": all_times[1]["y"]}]
-    result["main"]["all"]["values_time"] = all_times
-    all_dows = [{"x": i, "y": 0.0} for i in range(7)]
-    for c in results["dotw_all"]:
-        all_dows[c["dow"]]["y"] = c["severity"]
-    all_dows = [{"x": -1, "y": all_dows[-1]["y"]}] + all_dows + [{"x": 7, "y": all_dows[0]["y"]}]
-    result["main"]["all"]["values_dow"] = all_dows
-
-    data = {}
-    for r in results["crmtyp_all"]:
-        data[r["category"]] = r["count"]
-    n_data = {
-        "name": "Crime Type for All Data",
-        "children": []
-    }
-    for k1 in data:
-        t_d = {"name": k1, "count": data[k1]}
-        n_data["children"].append(t_d)
-    result["main"]["all"]["values_type"] = n_data
-
-    data = {}
-    for r in results["locdesc_all"]:
-        if r["locdesc1"] not in data:
-            data[r["locdesc1"]] = {}
-        if r["locdesc2"] not in data[r["locdesc1"]]:
-            data[r["locdesc1"]][r["locdesc2"]] = {}
-        data[r["locdesc1"]][r["locdesc2"]][r["locdesc3"]] = r["count"]
-    n_data = {
-        "name": "Location Description for All Data",
-        "children": []
-    }
-    for k1 in data:
-        t_d = {"name": k1, "children": []}
-        for k2 in data[k1]:
-            t_e = {"name": "{} | {}".format(k1,k2), "children": []}
-            for k3 in data[k1][k2]:
-                t_e["children"].append({"name": "{} | {} | {}".format(k1,k2,k3), "count": data[k1][k2][k3]})
-            t_d["children"].append(t_e)
-        n_data["children"].append(t_d)
-    result["main"]["all"]["values_locdesc"] = n_data
-
     if blockid != -1:
         result["main"][blockid] = {}
-        result["main"][blockid]["values_date"] = [{"x": "{}/{}".format(c["month"], c["year"]), "y": c["severity"]} for c in results["date"]]
-        times = [{"x": i, "y": 0.0} for i in range(24)]
-        for c in results["time_all"]:
-            times[c["hour"]]["y"] = c["severity"]
-        times = [{"x": -1, "y": times[-1]["y"]}] + times + [{"x": 24, "y": times[0]["y"]}, {"x": 25, "y": times[1]["y"]}]
-        result["main"][blockid]["values_time"] = times
-        dows = [{"x": i, "y": 0.0} for i in range(7)]
-        for c in results["dotw_all"]:
-            dows[c["dow"]]["y"] = c["severity"]
-        dows = [{"x": -1, "y": dows[-1]["y"]}] + dows + [{"x": 7, "y": dows[0]["y"]}]
-        result["main"][blockid]["values_dow"] = dows
-
-        data = {}
-        for r in results["crmtyp"]:
-            data[r["category"]] = r["count"]
-        n_data = {
-            "name": "Crime Type for All Data",
-            "children": []
-        }
-        for k1 in data:
-            t_d = {"name": k1, "count": data[k1]}
-            n_data["children"].append(t_d)
-        result["main"][blockid]["values_type"] = n_data
-
-        data = {}
-        for r in results["locdesc"]:
-            if r["locdesc1"] not in data:
-                data[r["locdesc1"]] = {}
-            if r["locdesc2"] not in data[r["locdesc1"]]:
-                data[r["locdesc1"]][r["locdesc2"]] = {}
-            data[r["locdesc1"]][r["locdesc2"]][r["locdesc3"]] = r["count"]
-        n_data = {
-            "name": "Location Description for All Data",
-            "children": []
-        }
-        for k1 in data:
-            t_d = {"name": k1, "children": []}
-            for k2 in data[k1]:
-                t_e = {"name": "{} | {}".format(k1,k2), "children": []}
-                for k3 in data[k1][k2]:
-                    t_e["children"].append({"name": "{} | {} | {}".format(k1,k2,k3), "count": data[k1][k2][k3]})
-                t_d["children"].append(t_e)
-            n_data["children"].append(t_d)
-        result["main"][blockid]["values_locdesc"] = n_data
-    job = Job(result=json.dumps(result))
-    SESSION.add(job)
-    SESSION.commit()
-    return job.id
+
+    order = [k for k in CHART_ORDER if k in charts]
+    if CHART_MODE == "frame":
+        with query("frame"):
+            frame = pd.DataFrame(SESSION.execute(text(query_frame), config_dict).fetchall(), columns=FRAME_COLUMNS)
+        masks = {"time": (frame["hour"] >= config_dict["stime"]) & (frame["hour"] <= config_dict["etime"])}
+        if "dow" in filters:
+            masks["dow"] = frame["dow"].isin(config_dict["dotw"])
+        if "crime" in filters:
+            masks["crime"] = frame["crimetypeid"].isin(config_dict["crimetypeids"])
+        if "locdesc" in filters:
+            masks["locdesc"] = frame["locdescid"].isin(config_dict["locdescids"])
+        if blockid != -1:
+            masks["block"] = frame["blockid"] == blockid
+        rows = ((k, frame_chart(frame, masks, *FRAME_CHARTS[k])) for k in order)
+    else:
+        rows = chart_rows(charts, config_dict, order)
+    for i, (k, res) in enumerate(rows):
+        with stage("format " + k):
+            format_chart(result, k, res, blockid, context)
+        with stage("progress"):
+            report_progress(job, i + 1, len(order), k, chart_output(result, k, blockid))
+
+    result_id = str(uuid.uuid4())
+    with stage("serialize") as serialize:
+        body = encode_json(result, encoder)
+        serialize.size = len(body)
+    with stage("write"), BACKEND.writer(result_id) as writer:
+        writer.write(body)
+    return result_id
+
+
+@job_session
+@timed_job("data")
+def get_data(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3, map_format="full", encoder="json"):
+    return compute_data(config_dict, blockid, dotw, crimetypes, locdesc1, locdesc2, locdesc3, map_format, encoder, get_current_job())
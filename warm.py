@@ -0,0 +1,93 @@
+"""Warms the caches of every city after a data load: the result of the
+    unfiltered /data request, the shapes and the predictions."""
+
+from decouple import config
+from rq import get_current_job
+
+import copy
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import utils
+from models import *
+from db import SESSION, job_session
+from cache import CONN, SHAPES_TTL, PREDICT_TTL, get_or_set_body, data_key, set_result
+from results import BACKEND
+from utils import compute_data, build_shapes, build_predict, invalidate_predict, PREDICT_FORMATS
+
+
+# Cities warmed at once, each process holding one DB connection at a time
+WARM_PROCESSES = config('WARM_PROCESSES', default=2, cast=int)
+
+
+def default_data_args(cityid):
+    """Get the get_data arguments of an unfiltered /data request of a city,
+        with the defaults app.get_city_data fills in."""
+    config_dict = {"cityid": cityid, "sdt": "01/01/1900", "edt": "01/01/2100", "stime": 0, "etime": 23}
+    return config_dict, -1, "", "", [""], [""], [""], "full", "json"
+
+
+def init_process():
+    """Run the chart queries of a city one after the other, so that warming
+        processes do not use more DB connections than their number."""
+    utils.CHART_WORKERS = 1
+
+
+def warm_city(cityid):
+    """Recompute the cached default data result, shapes and predictions of a
+        city. Returns the seconds each took, or the error that stopped it."""
+    timings = {"cityid": cityid}
+    try:
+        start = time.time()
+        args = default_data_args(cityid)
+        key = data_key(*args)
+        result_id = compute_data(copy.deepcopy(args[0]), *args[1:])
+        for evicted_id in set_result(key, result_id, BACKEND.size(result_id)):
+            BACKEND.delete(evicted_id)
+        timings["data"] = time.time() - start
+
+        start = time.time()
+        CONN.delete("shapes:{}:None".format(cityid))
+        get_or_set_body("shapes:{}:None".format(cityid), lambda: build_shapes(cityid), SHAPES_TTL)
+        timings["shapes"] = time.time() - start
+
+        start = time.time()
+        invalidate_predict(cityid)
+        for fmt in PREDICT_FORMATS:
+            get_or_set_body("predict:{}:{}".format(cityid, fmt), lambda: build_predict(cityid, fmt), PREDICT_TTL)
+        timings["predict"] = time.time() - start
+    except Exception as e:
+        timings["error"] = repr(e)
+    finally:
+        SESSION.remove()
+    return timings
+
+
+@job_session
+def warm_caches(cityids=None, processes=WARM_PROCESSES):
+    """Warm the caches of the given cities, or of all cities, on a pool of
+        processes. Per city timings are printed and saved in the job meta
+        under "warm" as cities finish."""
+    if cityids is None:
+        cityids = [r[0] for r in SESSION.query(City.id).order_by(City.id).all()]
+    SESSION.remove()
+    stats = {"done": 0, "total": len(cityids), "seconds": 0.0, "cities": []}
+    job = get_current_job()
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_process) as pool:
+        futures = [pool.submit(warm_city, cityid) for cityid in cityids]
+        for future in as_completed(futures):
+            timings = future.result()
+            stats["done"] += 1
+            stats["seconds"] = time.time() - start
+            stats["cities"].append(timings)
+            if "error" in timings:
+                print("Warming city {cityid} failed: {error}".format(**timings))
+            else:
+                print("Warmed city {cityid}: data {data:.2f}s, shapes {shapes:.2f}s, predict {predict:.2f}s".format(**timings))
+            sys.stdout.flush()
+            if job:
+                job.meta["warm"] = stats
+                job.save_meta()
+    return stats
@@ -1,15 +1,84 @@
 from decouple import config
 import redis
-from rq import Worker, Queue, Connection
-from utils import get_data
+from rq import Worker, SimpleWorker, Queue, Connection
+from rq.exceptions import NoSuchJobError
+from rq.utils import utcnow
+from sqlalchemy.orm import configure_mappers
+import sys
 
-listen = ['high', 'default', 'low']
+# Import the job modules in the worker process so that jobs start warm
+import utils
+import predictions
+import ingest
+import warm
+from db import ENGINE, SESSION
+from reference import reference
+from cache import publish_job
+
+# Queues to work on, e.g. `python worker.py export` for an export worker
+listen = sys.argv[1:] or config('WORKER_QUEUES', default='high,default,low').split(',')
+
+# Run each job in a forked work horse ("fork") or in the worker process itself
+# ("simple"), reusing its DB connections
+WORKER_MODE = config('WORKER_MODE', default='fork')
 
 redis_url = config('REDIS_URL')
 
 CONN = redis.from_url(redis_url)
 
+
+class EventMixin(object):
+    """Publishes the completion of each job to the Redis channel of the job,
+        for the job event streams of the web app, and reports the time each job
+        spent outside its function as its overhead."""
+
+    def handle_job_success(self, job, *args, **kwargs):
+        super(EventMixin, self).handle_job_success(job, *args, **kwargs)
+        publish_job(job.id, "completed")
+
+    def execute_job(self, job, queue):
+        start = utcnow()
+        super(EventMixin, self).execute_job(job, queue)
+        total = (utcnow() - start).total_seconds()
+        try:
+            job.refresh()
+        except NoSuchJobError:
+            return
+        if job.started_at and job.ended_at:
+            overhead = total - (job.ended_at - job.started_at).total_seconds()
+            job.meta["overhead"] = round(overhead, 4)
+            job.save_meta()
+            self.log.info("Job %s overhead %.4fs of %.4fs", job.id, overhead, total)
+
+
+class EventWorker(EventMixin, Worker):
+    pass
+
+
+class SimpleEventWorker(EventMixin, SimpleWorker):
+    pass
+
+
+def publish_failure(job, exc_type, exc_value, traceback):
+    publish_job(job.id, "failed")
+    return True
+
+
+def preload():
+    """Configure the ORM mappers and load the reference tables before the
+        first job, and open a pooled DB connection for the jobs of a simple
+        worker. Work horses of a forking worker open their own connections (see
+        db.detach_pool)."""
+    configure_mappers()
+    reference()
+    SESSION.remove()
+    if WORKER_MODE == 'simple':
+        ENGINE.connect().close()
+
+
 if __name__ == '__main__':
+    preload()
+    worker_class = SimpleEventWorker if WORKER_MODE == 'simple' else EventWorker
     with Connection(CONN):
-        worker = Worker(map(Queue, listen))
+        worker = worker_class(map(Queue, listen), exception_handlers=[publish_failure])
         worker.work()